@@ -6,7 +6,7 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from os import stat, remove
+from os import stat
 from os.path import join, basename, splitext, exists
 from logging import getLogger
 
@@ -14,12 +14,11 @@ import pandas as pd
 from burrito.parameters import FlagParameter, ValuedParameter
 from burrito.util import (
     ApplicationError, CommandLineApplication)
-from skbio import read
+from skbio import Sequence
 
 from .util import _get_parameter
+from ..util import _read_fasta, _write_fasta
 from ._base import MetadataPred
-import string
-import random
 
 _OPTIONS_FLAG = {
     i: _get_parameter(FlagParameter, i)
@@ -77,6 +76,18 @@ _OPTIONS_PATH = {
             # output file
             '--out']}
 
+# columns of the tabular output
+_TABULAR_COLUMNS = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch',
+                    'gapopen', 'qstart', 'qend', 'sstart', 'send',
+                    'evalue', 'bitscore']
+# e-values would underflow in float32, and the bitscores are returned
+# as they are in the file (float32 would turn 53.9 into 53.900001...)
+_TABULAR_DTYPES = {
+    'qseqid': 'category', 'sseqid': 'category', 'pident': 'float32',
+    'length': 'int32', 'mismatch': 'int32', 'gapopen': 'int32',
+    'qstart': 'int32', 'qend': 'int32', 'sstart': 'int32', 'send': 'int32',
+    'evalue': 'float64', 'bitscore': 'float64'}
+
 _PARAMETERS = {}
 _PARAMETERS.update(_OPTIONS_FLAG)
 _PARAMETERS.update(_OPTIONS_VALUE)
@@ -89,6 +100,8 @@ _PARAMETERS_BLAST = {
      '--query',
      '--tmpdir',
      '--daa',
+     '--out',
+     '--outfmt',
      '--gapopen',
      '--gapextend',
      '--matrix',
@@ -198,63 +211,128 @@ class FeatureAnnt(MetadataPred):
         self.dat = dat
 
     def _annotate_fp(self, fp, aligner='blastp', evalue=0.001, cpus=1,
-                     outfmt='tab', params=None):
-        '''Annotate the sequences in the file.'''
+                     outfmt='tab', daa=False, top=1, params=None):
+        '''Annotate the sequences in the file.
+
+        Parameters
+        ----------
+        fp : str
+            File path for the query sequences.
+        outfmt : str
+            Format of the search output ("tab" or "sam").
+        daa : bool
+            Whether to keep the search output in DAA format for
+            archival. If it is False, the output is written directly
+            in ``outfmt`` without running ``diamond view``.
+        top : int
+            The number of best hits to keep for each query.
 
-        if self.has_cache():
-            # Build cache
-            self.cache.build()
-            dbs = [self.cache.db] + self.dat
+        Returns
+        -------
+        pandas.DataFrame
+            The hits indexed by the query IDs, with the columns of
+            "sseqid", "evalue", "bitscore" and "partition", which is the
+            name of the database the hit is from. The partition and the
+            e-value are left empty for the hits against the cache.
+        '''
+        cache = self.cache if self.has_cache() else None
+        if cache is not None and cache.indexed:
+            # search the cache first; it is indexed once per run
+            dbs = [cache.db] + self.dat
         else:
             dbs = self.dat
-
-        found = []
-        res = pd.DataFrame()
+        if cache is not None and aligner == 'blastp':
+            queries = dict(_read_fasta(fp))
+        else:
+            # the nucleotide queries of blastx can't stand in for proteins
+            queries = {}
+        columns = ['sseqid', 'evalue', 'bitscore']
+        if cache is not None:
+            columns.append('pident')
+
+        # the IDs of the query seqs that already hit a database
+        found = set()
+        # collect the hit tables and concatenate them once at the end
+        hits = []
         seqs = []
         for db in dbs:
             out_prefix = splitext(basename(db))[0]
-            daa_fp = join(self.out_dir, '%s.daa' % out_prefix)
             out_fp = join(self.out_dir, '%s.diamond' % out_prefix)
-            self.run_blast(fp, daa_fp, db, aligner=aligner,
-                           evalue=evalue, cpus=cpus, params=params)
-            self.run_view(daa_fp, out_fp, params={'--outfmt': outfmt})
-            res = res.append(self.parse_tabular(out_fp))
+            if daa:
+                daa_fp = join(self.out_dir, '%s.daa' % out_prefix)
+                self.run_blast(fp, daa_fp, db, aligner=aligner,
+                               evalue=evalue, cpus=cpus, params=params)
+                self.run_view(daa_fp, out_fp, params={'--outfmt': outfmt})
+            else:
+                self.run_blast(fp, out_fp, db, aligner=aligner,
+                               evalue=evalue, cpus=cpus, outfmt=outfmt,
+                               params=params)
+            # only the seqs left from the previous db are searched, so
+            # the hits of each db are disjoint.
+            if outfmt == 'sam':
+                res_ = self.parse_sam(out_fp, column='bitscore', top=top,
+                                      columns=columns)
+            else:
+                res_ = self.parse_tabular(out_fp, top=top, columns=columns)
+            if cache is not None:
+                near = (res_['pident'] >= cache.min_identity).values
+                res_ = res_.drop('pident', axis=1)
+                if db == cache.db:
+                    # only the close hits of the stand-ins are accepted and
+                    # their e-values against the small cache db are dropped
+                    res_ = res_[near].assign(evalue=float('nan'))
+                    cache.touch(res_['sseqid'][~res_.index.duplicated()])
+                else:
+                    # the query stands in for the reference protein it hit
+                    # closely enough
+                    best = res_[near & ~res_.index.duplicated()]
+                    seqs.extend(Sequence(queries[q], {'id': s})
+                                for q, s in best['sseqid'].items()
+                                if q in queries)
+            if cache is not None and db == cache.db:
+                res_ = res_.assign(partition=None)
+            else:
+                res_ = res_.assign(partition=out_prefix)
+            hits.append(res_)
+            found.update(res_.index)
 
-            found.extend(res.index)
             # save to a tmp file the seqs that do not hit current database
             new_fp = join(self.tmp_dir, '%s.fa' % out_prefix)
-            with open(new_fp, 'w') as f:
-                for seq in read(fp, format='fasta'):
-                    if seq.metadata['id'] not in found:
-                        seq.write(f, format='fasta')
-                        seqs.append(seq)
+            left = _filter_fasta(fp, new_fp, found)
             # no seq left
-            if stat(new_fp).st_size == 0:
+            if not left:
                 break
             else:
                 fp = new_fp
 
-        # Update cache (inplace)
-        if self.has_cache():
-            self.cache.update(seqs)
-            self.cache.close()
-        return res
+        # Update cache (inplace); the new entries are indexed and
+        # persisted once at the end of the run (see ``DiamondCache``)
+        if cache is not None:
+            cache.update(seqs)
+        if hits:
+            return pd.concat(hits)
+        return pd.DataFrame()
 
-    def run_blast(self, fp, daa_fp, db, aligner='blastp', evalue=0.001, cpus=1,
-                  params=None):
+    def run_blast(self, fp, out_fp, db, aligner='blastp', evalue=0.001,
+                  cpus=1, outfmt=None, params=None):
         '''Search query sequences against the database.
 
         Parameters
         ----------
         fp : str
             File path for the query sequence.
-        daa_fp : str
+        out_fp : str
             Output file path.
         cpus : int
             Number of CPUs. Default to 1. If it is set to 0, it will use
-            all available CPUs.
+            all available CPUs. It is ignored if ``--threads`` is set
+            in ``params``.
         evalue : float
             Default to 0.01. Threshold E-value.
+        outfmt : str or None
+            Format of the output ("tab" or "sam"). If it is None, the
+            output is written in DAA format, which can be converted
+            with ``run_view``.
         params : dict
             Other command line parameters for diamond blastp. key is the option
             (e.g. "-T") and value is the value for the option (e.g. "50").
@@ -276,10 +354,15 @@ class FeatureAnnt(MetadataPred):
 
         blast = app(InputHandler='_input_as_paths', params=params)
         blast.Parameters['--query'].on(fp)
-        blast.Parameters['--daa'].on(daa_fp)
+        if outfmt is None:
+            blast.Parameters['--daa'].on(out_fp)
+        else:
+            blast.Parameters['--out'].on(out_fp)
+            blast.Parameters['--outfmt'].on(outfmt)
         blast.Parameters['--db'].on(db)
         blast.Parameters['--evalue'].on(evalue)
-        blast.Parameters['--threads'].on(cpus)
+        if params is None or '--threads' not in params:
+            blast.Parameters['--threads'].on(cpus)
         blast.Parameters['--tmpdir'].on(self.tmp_dir)
 
         logger.info('Running: %s' % blast.BaseCommand)
@@ -295,9 +378,11 @@ class FeatureAnnt(MetadataPred):
             Input file resulting from diamond blast.
         out_fp : str
             Output file.
+        params : dict
+            Other command line parameters for diamond view.
         '''
         logger = getLogger(__name__)
-        view = DiamondView(InputHandler='_input_as_paths')
+        view = DiamondView(InputHandler='_input_as_paths', params=params)
         view.Parameters['--daa'].on(daa_fp)
         view.Parameters['--out'].on(out_fp)
         logger.info('Running: %s' % view.BaseCommand)
@@ -306,35 +391,63 @@ class FeatureAnnt(MetadataPred):
         return view_res
 
     @staticmethod
-    def parse_tabular(diamond_res, column='bitscore'):
+    def parse_tabular(diamond_res, column='bitscore', top=1, ties=False,
+                      chunksize=1000000,
+                      columns=('sseqid', 'evalue', 'bitscore')):
         '''Parse the output of diamond blastp/blastx.
 
+        The file is read in chunks with compact column types and only
+        the best hits of each query seen so far are kept, so a result
+        file of any size is parsed in bounded memory.
+
         Parameters
         ----------
         diamond_res : str
             file path
         column : str
             The column used to pick the best hits.
+        top : int
+            The number of best hits to keep for each query.
+        ties : bool
+            Whether to also keep the hits tied with the ``top``-th best
+            hit of a query. Otherwise, the hits occurring first in the
+            file are kept.
+        chunksize : int
+            The number of lines to read at a time.
+        columns : iterable of str
+            The columns to return.
 
         Returns
         -------
         pandas.DataFrame
             The best matched records for each query sequence.
         '''
-        columns = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch',
-                   'gapopen', 'qstart', 'qend', 'sstart', 'send',
-                   'evalue', 'bitscore']
-        df = pd.read_table(diamond_res, names=columns)
-        # pick the rows that have highest bitscore for each qseqid
-        # df_max = df.groupby('qseqid').apply(
-        #     lambda r: r[r[column] == r[column].max()])
-        idx = df.groupby('qseqid')[column].idxmax()
-        df_max = df.loc[idx]
-        df_max.index = idx.index
-        return df_max[['sseqid', 'evalue', 'bitscore']]
+        usecols = ['qseqid', 'sseqid', 'evalue', 'bitscore']
+        for i in list(columns) + [column]:
+            if i not in usecols:
+                usecols.append(i)
+        if stat(diamond_res).st_size == 0:
+            best = pd.DataFrame(columns=usecols)
+        else:
+            best = None
+            reader = pd.read_csv(
+                diamond_res, sep='\t', names=_TABULAR_COLUMNS,
+                usecols=usecols, dtype=_TABULAR_DTYPES,
+                chunksize=chunksize)
+            for chunk in reader:
+                # the hits kept so far go first to retain the file order
+                if best is not None:
+                    chunk = pd.concat([best, chunk])
+                best = _top_hits(chunk, column, top, ties)
+        for i in ['qseqid', 'sseqid']:
+            best[i] = best[i].astype(str)
+        best = best.sort_values('qseqid', kind='mergesort')
+        best = best.set_index('qseqid')
+        return best[list(columns)]
 
     @staticmethod
-    def parse_sam(diamond_res, column=None, collapse=False):
+    def parse_sam(diamond_res, column=None, collapse=False, top=1,
+                  columns=('sseqid', 'evalue', 'bitscore', 'sequence')):
         '''Parse the output of diamond blastp/blastx.
 
         Parameters
@@ -343,91 +456,274 @@ class FeatureAnnt(MetadataPred):
             file path
         column : str
             The column used to pick the best hits.
+        collapse : bool
+            Whether to merge the alignments of a query to the same
+            subject into the best one of them (by ``column`` or,
+            if it is not given, by bitscore).
+        top : int
+            The number of best hits to keep for each query if ``column``
+            is given.
+        columns : iterable of str
+            The columns to return.
 
         Returns
         -------
         pandas.DataFrame
             The best matched records for each query sequence.
         '''
-        seqs = read(diamond_res, format='sam')
-        columns = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch',
-                   'gapopen', 'qstart', 'qend', 'sstart', 'send',
-                   'evalue', 'bitscore', 'sequence']
-        df = pd.DataFrame(columns=columns)
-        for i, seq in enumerate(seqs):
-            s = str(seq)
-
-            qseqid = seq.metadata['QNAME']
-            sseqid = seq.metadata['RNAME']
-            pident = seq.metadata['ZI']
-            length = seq.metadata['ZL']
-            mismatch = seq.metadata['CIGAR']
-            gapopen = ''
-            qstart = seq.metadata['POS']
-            qend = ''
-            sstart = seq.metadata['ZS']
-            send = ''
-            evalue = seq.metadata['ZE']
-            bitscore = seq.metadata['ZR']
-            row = pd.Series([qseqid, sseqid, pident,
-                             length, mismatch, gapopen,
-                             qstart, qend, sstart, send,
-                             evalue, bitscore, s],
-                            index=columns)
-            df.loc[i] = row
-
+        df = _read_sam(diamond_res)
+        if collapse:
+            by = 'bitscore' if column is None else column
+            df = _top_hits(df, by, keys=['qseqid', 'sseqid'])
+            df = df.sort_index(kind='mergesort')
         if column is not None:
-            idx = df.groupby('qseqid')[column].idxmax()
-            df_max = df.loc[idx]
-            df_max.index = idx.index
-            df = df_max[['sseqid', 'evalue', 'bitscore', 'sequence']]
-        else:
-            df = df[['sseqid', 'evalue', 'bitscore', 'sequence']]
-        return df
+            df = _top_hits(df, column, top)
+            df = df.sort_values('qseqid', kind='mergesort')
+            df = df.set_index('qseqid')
+        return df[list(columns)]
 
 
-class DiamondCache():
+def _read_sam(fp):
+    '''Read the alignments of DIAMOND SAM output into a hit table.
+
+    The fields are collected into columns and the table is built once.
+
+    Parameters
+    ----------
+    fp : str
+        file path
+
+    Returns
+    -------
+    pandas.DataFrame
+        The alignments in the columns of the tabular output, with
+        the aligned query sequence in the extra column "sequence".
+    '''
+    required = {i: [] for i in ['QNAME', 'RNAME', 'POS', 'CIGAR', 'SEQ']}
+    optional = {i: [] for i in ['ZI', 'ZL', 'ZS', 'ZE', 'ZR']}
+    with open(fp) as fh:
+        for line in fh:
+            if line.startswith('@') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            for k, i in zip(['QNAME', 'RNAME', 'POS', 'CIGAR', 'SEQ'],
+                            [0, 2, 3, 5, 9]):
+                required[k].append(fields[i])
+            # optional fields are in the form of TAG:TYPE:VALUE
+            tags = {i[:2]: i[5:] for i in fields[11:]}
+            for k in optional:
+                optional[k].append(tags.get(k))
+    num = len(required['QNAME'])
+    df = pd.DataFrame({
+        'qseqid': required['QNAME'],
+        'sseqid': required['RNAME'],
+        'pident': pd.to_numeric(optional['ZI']),
+        'length': pd.to_numeric(optional['ZL']),
+        'mismatch': required['CIGAR'],
+        'gapopen': [''] * num,
+        'qstart': pd.to_numeric(required['POS']),
+        'qend': [''] * num,
+        'sstart': pd.to_numeric(optional['ZS']),
+        'send': [''] * num,
+        'evalue': pd.to_numeric(optional['ZE']),
+        'bitscore': pd.to_numeric(optional['ZR']),
+        'sequence': required['SEQ']},
+        columns=_TABULAR_COLUMNS + ['sequence'])
+    return df
+
+
+def _top_hits(df, column, top=1, ties=False, keys=('qseqid',)):
+    '''Select the best hits for each query.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The hits with a column of "qseqid".
+    column : str
+        The column used to pick the best hits.
+    top : int
+        The number of best hits to keep for each query.
+    ties : bool
+        Whether to also keep the hits tied with the ``top``-th best one.
+    keys : iterable of str
+        The columns identifying a query.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The best hits sorted by the column in descending order.
     '''
+    # stable sort so the tied hits stay in their order of occurrence
+    df = df.sort_values(column, ascending=False, kind='mergesort')
+    group = df.groupby([pd.factorize(df[i])[0] for i in keys], sort=False)
+    if ties:
+        keep = group[column].rank(method='min', ascending=False) <= top
+    else:
+        keep = group.cumcount() < top
+    return df[keep.values]
+
+
+def _filter_fasta(in_fp, out_fp, exclude):
+    '''Copy the fasta records except those with the IDs to exclude.
+
+    It is done in a single streaming pass over the input file. The
+    descriptions of the records are not copied.
+
+    Parameters
+    ----------
+    in_fp : str
+        The input fasta file.
+    out_fp : str
+        The output fasta file.
+    exclude : set of str
+        The IDs of the records to skip.
+
+    Returns
+    -------
+    int
+        The number of records written.
+    '''
+    count = 0
+
+    def kept():
+        nonlocal count
+        for id, seq in _read_fasta(in_fp):
+            if id not in exclude:
+                count += 1
+                yield id, seq
+
+    _write_fasta(out_fp, kept())
+    return count
+
+
+class DiamondCache():
+    '''A bounded and persistent cache of the recently hit reference proteins.
+
+    It is searched before the reference databases, so the proteins
+    similar to the ones annotated recently are resolved with a search
+    against a small database. Each entry is keyed by the ID of a
+    reference protein and holds a query protein that hit it with at
+    least ``min_identity`` percent identity, which stands in for the
+    reference sequence. The hits against the cache are accepted at the
+    same identity only, so a chain of stand-ins can't drift far from the
+    reference. Their e-values are not comparable to those against the
+    reference databases and are left empty.
+
+    The database is indexed with ``build`` once at the start of a run;
+    the entries added during the run are searched from the next run on.
+    The entries are evicted by the policy once there are more than
+    ``maxSize`` of them and kept in ``out_dir`` across runs with
+    ``close`` at the end of the run.
+
     Attributes
     ----------
     out_dir : str
         output directory file path
-    fname : str
+    fasta : str
         fasta file to store cached sequences
     db : str
         diamond database to store cached sequences
+    index : str
+        the file to persist the entries and their usage
     maxSize : int
         maxinum size of DiamondCache
-    seqs : list of skbio.Sequence
-        list of sequence objects
+    policy : str
+        The eviction policy. "lru" evicts the least recently used entries
+        and "lfu" evicts the least frequently used ones.
+    min_identity : float
+        The minimal percent identity of the stand-ins to the reference
+        proteins and of the accepted hits to the stand-ins.
+    indexed : bool
+        Whether the database is built and can be searched.
     '''
-    def __init__(self, seqs=None, maxSize=200000, out_dir=""):
+    def __init__(self, seqs=None, maxSize=200000, out_dir="", policy='lru',
+                 min_identity=95.0):
+        if policy not in {'lru', 'lfu'}:
+            raise ValueError('Unknown eviction policy: %s.' % policy)
         self.out_dir = out_dir
-        self.fname = self._generate_random_file()  # substitute for tempfile
-        self.fasta = join(out_dir, '%s.fasta' % self.fname)
-        self.db = join(out_dir, '%s.dmnd' % self.fname)
+        self.fasta = join(out_dir, 'cache.fasta')
+        self.db = join(out_dir, 'cache.dmnd')
+        self.index = join(out_dir, 'cache.tsv')
         self.maxSize = maxSize
-        self.seqs = seqs
+        self.policy = policy
+        self.min_identity = min_identity
+        self.indexed = False
+        # ID -> [sequence, number of hits, time of last use]
+        self._entries = {}
+        self._clock = 0
+        # whether the entries (and so the database) have changed
+        self._dirty = False
+        # whether the usage of the entries has changed
+        self._touched = False
+        if exists(self.index):
+            self._load()
+        if seqs is not None:
+            self.update(seqs)
+
+    def _load(self):
+        with open(self.index) as f:
+            for line in f:
+                id, seq, hits, used = line.rstrip('\n').split('\t')
+                self._entries[id] = [seq, int(hits), int(used)]
+        if self._entries:
+            self._clock = max(i[2] for i in self._entries.values())
+        # the database is stale if it was not re-indexed after a change
+        if exists(self.db) and exists(self.fasta):
+            with open(self.fasta) as f:
+                ids = {line[1:].rstrip('\n') for line in f
+                       if line.startswith('>')}
+            self._dirty = ids != set(self._entries)
+        else:
+            self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, id):
+        return id in self._entries
 
-    def _generate_random_file(self, N=10):
-        s = ''.join(random.SystemRandom().choice(
-                string.ascii_uppercase + string.digits) for _ in range(N))
-        # look for unique filepath
-        while exists(join(self.out_dir, s)):
-            s = ''.join(random.SystemRandom().choice(
-                    string.ascii_uppercase + string.digits) for _ in range(N))
-        return s
+    @property
+    def seqs(self):
+        '''The cached sequences from the most recently used.'''
+        entries = sorted(self._entries.items(), key=lambda i: -i[1][2])
+        return [Sequence(seq, {'id': id}) for id, (seq, _, _) in entries]
 
     def dbname(self):
-        return self.db.name
+        return self.db
 
     def is_empty(self):
-        return (self.seqs is None) or len(self.seqs) == 0
+        return len(self._entries) == 0
 
     def build(self, params=None):
-        for seq in self.seqs:
-            seq.write(self.fasta, format='fasta')
-        make_db(self.fasta, self.db, params)
+        '''Index the cached sequences if they have changed.
+
+        The database is not built if the cache is empty.
+        '''
+        if self.is_empty():
+            self.indexed = False
+            return
+        if self._dirty or not exists(self.db):
+            _write_fasta(self.fasta, ((id, entry[0])
+                                      for id, entry in self._entries.items()))
+            make_db(self.fasta, self.db, params)
+            self._dirty = False
+        self.indexed = True
+
+    def touch(self, ids):
+        '''Record the use of the cached entries.
+
+        Parameters
+        ----------
+        ids : iterable of str
+            The IDs of the entries hit.
+        '''
+        for id in ids:
+            entry = self._entries.get(id)
+            if entry is not None:
+                self._clock += 1
+                entry[1] += 1
+                entry[2] = self._clock
+                self._touched = True
 
     def update(self, seqs):
         """
@@ -436,9 +732,38 @@ class DiamondCache():
         seqs : list of skbio.Sequence
            List of sequences to update the cache.
         """
-        self.seqs = seqs + self.seqs
-        self.seqs = self.seqs[:self.maxSize]
+        for seq in seqs:
+            id = seq.metadata['id']
+            self._clock += 1
+            if id in self._entries:
+                entry = self._entries[id]
+                entry[1] += 1
+                entry[2] = self._clock
+            else:
+                self._entries[id] = [str(seq), 1, self._clock]
+                self._dirty = True
+        self._touched = True
+        self._evict()
+
+    def _evict(self):
+        excess = len(self._entries) - self.maxSize
+        if excess <= 0:
+            return
+        if self.policy == 'lru':
+            def key(i):
+                return i[1][2]
+        else:
+            def key(i):
+                return (i[1][1], i[1][2])
+        for id, _ in sorted(self._entries.items(), key=key)[:excess]:
+            del self._entries[id]
+        self._dirty = True
 
     def close(self):
-        remove(self.fasta)
-        remove(self.db)
+        '''Persist the entries so they are reused in later runs.'''
+        if not (self._touched or self._dirty):
+            return
+        with open(self.index, 'w') as f:
+            for id, (seq, hits, used) in self._entries.items():
+                f.write('%s\t%s\t%d\t%d\n' % (id, seq, hits, used))
+        self._touched = False
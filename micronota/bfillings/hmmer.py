@@ -6,10 +6,16 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from os.path import join
+from tempfile import mkdtemp
+from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
+
 from burrito.parameters import FlagParameter, ValuedParameter
 
 from .util import _get_parameter
 from .model import ModelFetch, ModelPress, ModelScan
+from ..util import _split_fasta
 
 
 class HMMScan(ModelScan):
@@ -111,9 +117,18 @@ def hmmpress_hmm(hmm, force=False):
     return res
 
 
-def hmmscan_fasta(hmm, in_fp, out_fp, evalue=0.01, cores=0, params=None):
+def hmmscan_fasta(hmm, in_fp, out_fp, evalue=0.01, cores=0, params=None,
+                  shards=1):
     '''Scan a fasta file against a covariance model database.
 
+    With ``shards`` larger than 1, the input is split into chunks of
+    about the same total length, which are scanned by concurrent
+    hmmscan processes sharing the ``cores``; no more shards than cores
+    run at a time and each gets at least one. It scales better than the
+    threads of a single hmmscan. The E-values are the same as scanning
+    the whole input at once, because the search space of each query is
+    the number of models in the database.
+
     Parameters
     ----------
     hmm : str
@@ -124,12 +139,15 @@ def hmmscan_fasta(hmm, in_fp, out_fp, evalue=0.01, cores=0, params=None):
         Output file path of target hits table.
     cores : int
         Number of CPU cores. Default to zero, i.e. running in serial-only mode.
+        It is ignored if ``--cpu`` is set in ``params``.
     evalue : float
         Default to 0.01. Threshold E-value.
     params : dict
         Other command line parameters for hmmscan. key is the option
         (e.g. "-T") and value is the value for the option (e.g. "50").
         If the option is a flag, set the value to None.
+    shards : int
+        Number of hmmscan processes to run in parallel.
 
     Returns
     -------
@@ -138,9 +156,72 @@ def hmmscan_fasta(hmm, in_fp, out_fp, evalue=0.01, cores=0, params=None):
         output files, which can be accessed in a dict style with the
         keys of "StdOut", "StdErr", "--tblout". The exit status
         of the run can be similarly fetched with the key of "ExitStatus".
+        With shards, it only contains the merged "--tblout" and the
+        exit status.
     '''
+    if shards > 1:
+        return _hmmscan_shards(hmm, in_fp, out_fp, evalue, cores, params,
+                               shards)
     app = HMMScan(InputHandler='_input_as_paths', params=params)
     app.Parameters['--incE'].on(evalue)
-    app.Parameters['--cpu'].on(cores)
+    if params is None or '--cpu' not in params:
+        app.Parameters['--cpu'].on(cores)
     app.Parameters['--tblout'].on(out_fp)
     return app([hmm, in_fp])
+
+
+def _hmmscan_shards(hmm, in_fp, out_fp, evalue, cores, params, shards):
+    '''Scan the chunks of a fasta file in parallel.
+
+    See ``hmmscan_fasta`` for the parameters.
+    '''
+    tmp_dir = mkdtemp(prefix='hmmscan')
+    try:
+        chunks = _split_fasta(in_fp, shards, join(tmp_dir, 'shard'))
+        if len(chunks) < 2:
+            # nothing to split; it also reports the errors of the input
+            return hmmscan_fasta(hmm, in_fp, out_fp, evalue, cores, params)
+        outs = ['%s.tblout' % i for i, _ in chunks]
+        # share the cores out among the shards running at a time
+        workers = min(len(chunks), max(1, cores))
+        cpu = max(1, cores // workers) if cores else 0
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(hmmscan_fasta, hmm, i, o, evalue,
+                                       cpu, params)
+                       for (i, _), o in zip(chunks, outs)]
+            for i in futures:
+                for v in i.result().values():
+                    if hasattr(v, 'close'):
+                        v.close()
+        _merge_tblout(outs, out_fp)
+    finally:
+        rmtree(tmp_dir)
+    return {'ExitStatus': 0, '--tblout': open(out_fp)}
+
+
+def _merge_tblout(fps, out_fp):
+    '''Merge the hit tables of hmmscan.
+
+    The column headers and the trailing run information are taken from
+    the first table. The hits are kept in the order of the tables.
+
+    Parameters
+    ----------
+    fps : list of str
+        The input hit tables (``--tblout``).
+    out_fp : str
+        The output hit table.
+    '''
+    with open(fps[0]) as f:
+        lines = f.readlines()
+    # the column headers end with the dashed line
+    end = next((i + 1 for i, line in enumerate(lines)
+                if line.startswith('#-')), 0)
+    trailer = [i for i in lines[end:] if i.startswith('#')]
+    with open(out_fp, 'w') as out:
+        out.writelines(lines[:end])
+        out.writelines(i for i in lines[end:] if not i.startswith('#'))
+        for fp in fps[1:]:
+            with open(fp) as f:
+                out.writelines(i for i in f if not i.startswith('#'))
+        out.writelines(trailer)
@@ -128,6 +128,7 @@ def cmscan_fasta(cm, in_fp, out_fp, evalue=0.01, cores=0, params=None):
         Output file path of target hits table.
     cores : int
         Number of CPU cores. Default to zero, i.e. running in serial-only mode.
+        It is ignored if ``--cpu`` is set in ``params``.
     evalue : float
         Default to 0.01. Threshold E-value.
     params : dict
@@ -145,6 +146,7 @@ def cmscan_fasta(cm, in_fp, out_fp, evalue=0.01, cores=0, params=None):
     '''
     app = CMScan(InputHandler='_input_as_paths', params=params)
     app.Parameters['--incE'].on(evalue)
-    app.Parameters['--cpu'].on(cores)
+    if params is None or '--cpu' not in params:
+        app.Parameters['--cpu'].on(cores)
     app.Parameters['--tblout'].on(out_fp)
     return app([cm, in_fp])
@@ -6,11 +6,15 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from os.path import join, basename, splitext
+from os import makedirs, replace
+from os.path import join, basename, splitext, exists, dirname, abspath
+from itertools import repeat
+from tempfile import mkdtemp
+from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import re
 
-from skbio import read
 from skbio.metadata import Feature
 from skbio.io.format.genbank import _parse_features
 from burrito.parameters import FlagParameter, ValuedParameter
@@ -18,6 +22,8 @@ from burrito.util import CommandLineApplication, ResultPath
 
 from ._base import IntervalMetadataPred
 from ..parsers.embl import _parse_records
+from ..parsers.faa import read_faa_table
+from ..util import _split_fasta
 
 
 class Prodigal(CommandLineApplication):
@@ -91,22 +97,175 @@ class Prodigal(CommandLineApplication):
         return result
 
 
+# the sequence ordinals in the output of Prodigal
+_NUMBERING = re.compile(rb'(seqnum=|(?:# |\t|")ID=)([0-9]+)(?=[_;])')
+
+
+def _renumber(data, offset):
+    '''Shift the sequence ordinals in the output of Prodigal.'''
+    if offset == 0:
+        return data
+    return _NUMBERING.sub(
+        lambda m: m.group(1) + str(int(m.group(2)) + offset).encode(), data)
+
+
+# the options that change the training of Prodigal
+_TRAINING_OPTIONS = ['-g', '-c', '-m', '-n']
+
+
 class FeaturePred(IntervalMetadataPred):
-    def _identify_fp(self, fp, params=None) -> dict:
-        '''Predict genes for the input sequence with Prodigal.'''
-        res = self.run(fp, params)
+    def _identify_fp(self, fp, cpus=1, params=None,
+                     training_file=None) -> dict:
+        '''Predict genes for the input sequence with Prodigal.
+
+        The genes are parsed from the protein translations, so the
+        annotation file defaults to the compact sco format ("-f") and
+        the nucleotide sequences of the genes are only written if "-d"
+        is in ``params``. Its value is ignored, as all the output files
+        are written in ``out_dir``. In the metagenomic mode, the input is
+        split to run on ``cpus`` cores.
+        In the single mode, the genes are predicted with
+        ``training_file`` if it is given (see ``train``), unless one is
+        given with "-t".
+        '''
+        params = {} if params is None else dict(params)
+        params.setdefault('-f', 'sco')
+        nucl = '-d' in params
+        if (training_file is not None and '-t' not in params and
+                params.get('-p', 'single') == 'single'):
+            params['-t'] = self.train(fp, training_file, params)
+        if cpus > 1 and params.get('-p') == 'meta':
+            res = self.run_parallel(fp, cpus, params, nucl=nucl)
+        else:
+            res = self.run(fp, params, nucl=nucl)
         return self.parse_result(res)
 
-    def run(self, fp, params=None):
+    def train(self, fp, training_file, params=None):
+        '''Get the training file for the input genome.
+
+        The training file for the single mode is reused by its name,
+        so a file named after a strain or a taxon (eg
+        "training/Escherichia.trn") is shared by all the genomes
+        annotated with it, eg the drafts of related strains. If it does
+        not exist yet, it is trained on the input, which should then be
+        a whole genome rather than a single contig, and saved there.
+
+        Parameters
+        ----------
+        fp : str
+            The input genome file.
+        training_file : str
+            The training file.
+        params : dict
+            Other command line parameters for Prodigal. Only the ones
+            affecting the training are used.
+
+        Returns
+        -------
+        str
+            The path of the training file.
+        '''
+        logger = logging.getLogger(__name__)
+        params = {} if params is None else params
+        if exists(training_file):
+            logger.info('Reusing training file %s' % training_file)
+            return training_file
+        training_dir = dirname(abspath(training_file))
+        makedirs(training_dir, exist_ok=True)
+        # write it aside first, so concurrent runs never read a
+        # partial training file
+        tmp_dir = mkdtemp(prefix='tmp', dir=training_dir)
+        try:
+            tmp_fp = join(tmp_dir, basename(training_file))
+            train_params = {i: params[i] for i in _TRAINING_OPTIONS
+                            if i in params}
+            # Prodigal only writes the training file if it does not exist
+            train_params.update({'-i': fp, '-t': tmp_fp})
+            app = Prodigal(params=train_params)
+            logger.info('Running: %s' % app.BaseCommand)
+            res = app()
+            for v in res.values():
+                if hasattr(v, 'close'):
+                    v.close()
+            replace(tmp_fp, training_file)
+        finally:
+            rmtree(tmp_dir)
+        return training_file
+
+    def run_parallel(self, fp, cpus, params=None, nucl=True):
+        '''Predict genes for the input file with concurrent Prodigal runs.
+
+        The input is split into contiguous chunks of about the same
+        total length, which are run at the same time and whose outputs
+        are concatenated with the sequences renumbered in the input
+        order. It is only equivalent to ``run`` in the metagenomic mode
+        ("-p meta"), where each sequence is predicted on its own.
+
+        Parameters
+        ----------
+        cpus : int
+            The maximal number of Prodigal processes.
+        params : dict
+            Other command line parameters for Prodigal. See ``run``.
+        nucl : bool
+            Whether to write the nucleotide sequences of the genes.
+
+        Returns
+        -------
+        dict
+            The opened output files keyed by their options and the exit
+            status as in the result of ``run``.
+        '''
+        chunk_dir = mkdtemp(prefix='chunks', dir=self.tmp_dir)
+        results = []
+        try:
+            chunks = _split_fasta(fp, cpus, join(chunk_dir, 'chunk'))
+            if len(chunks) < 2:
+                return self.run(fp, params, nucl)
+            pred = FeaturePred(self.dat, chunk_dir, chunk_dir)
+            with ThreadPoolExecutor(len(chunks)) as executor:
+                futures = [executor.submit(pred.run, i, params, nucl)
+                           for i, _ in chunks]
+                for i in futures:
+                    results.append(i.result())
+            offsets = [0]
+            for _, n in chunks[:-1]:
+                offsets.append(offsets[-1] + n)
+
+            merged = {'ExitStatus': 0}
+            out_prefix = splitext(basename(fp))[0]
+            for opt in ['-a', '-d', '-o']:
+                if opt not in results[0]:
+                    continue
+                suffix = splitext(results[0][opt].name)[1]
+                out_fp = join(self.out_dir, out_prefix + suffix)
+                with open(out_fp, 'wb') as out:
+                    for res, offset in zip(results, offsets):
+                        with open(res[opt].name, 'rb') as f:
+                            data = f.read()
+                        if offset and data.startswith(b'##gff-version'):
+                            # keep only the first header
+                            data = data[data.find(b'\n') + 1:]
+                        out.write(_renumber(data, offset))
+                merged[opt] = open(out_fp)
+            return merged
+        finally:
+            for res in results:
+                for v in res.values():
+                    if hasattr(v, 'close'):
+                        v.close()
+            rmtree(chunk_dir)
+
+    def run(self, fp, params=None, nucl=True):
         '''Predict genes for the input file.
 
         Notes
         -----
         It will create 3 output files:
-          1. the annotation file in format of GFF3 or
+          1. the annotation file in format of GFF3, SCO or
              GenBank feature table with .gbk suffix.
           2. the nucleotide sequences for each predicted gene
-             with file suffix of .fna.
+             with file suffix of .fna, unless ``nucl`` is False.
           3. the protein sequence translated from each gene
              with file suffix of .faa.
 
@@ -116,6 +275,8 @@ class FeaturePred(IntervalMetadataPred):
             Other command line parameters for Prodigal. key is the option
             (e.g. "-p") and value is the value for the option (e.g. "single").
             If the option is a flag, set the value to None.
+        nucl : bool
+            Whether to write the nucleotide sequences of the genes.
 
         Returns
         -------
@@ -127,8 +288,8 @@ class FeaturePred(IntervalMetadataPred):
         '''
         logger = logging.getLogger(__name__)
 
-        if params is None:
-            params = {}
+        # don't modify the input
+        params = {} if params is None else dict(params)
 
         # default output is genbank
         f_param = params.get('-f', 'gbk')
@@ -138,6 +299,9 @@ class FeaturePred(IntervalMetadataPred):
             # output file of nucleotide sequences of genes
             '-d': 'fna',
             '-o': f_param}
+        if not nucl:
+            del out_suffices['-d']
+            params.pop('-d', None)
         out_prefix = splitext(basename(fp))[0]
         for i in out_suffices:
             out_fp = join(self.out_dir,
@@ -159,15 +323,27 @@ class FeaturePred(IntervalMetadataPred):
         ----------
         res : burrito.util.CommandLineAppResult
         which : which output to parse
+            "-a" for the protein translations or "-o" for the
+            annotation file in GenBank format.
         Returns
         -------
         ``skbio.metadata.IntervalMetadata``
+
+        Raises
+        ------
+        ValueError
+            If the annotation file is not in GenBank format.
         '''
         # make sure to move to the beginning of the file.
         if which == '-a':
             return self._parse_faa(res[which])
         elif which == '-o':
-            return _parse_records(res[which], self._parse_single_record)
+            f = res[which]
+            if splitext(f.name)[1] != '.gbk':
+                raise ValueError(
+                    'Only the annotation file in GenBank format can be '
+                    'parsed. Parse the protein translations instead.')
+            return _parse_records(f, self._parse_single_record)
 
     @staticmethod
     def _parse_single_record(chunks):
@@ -201,55 +377,76 @@ class FeaturePred(IntervalMetadataPred):
         Yields
         ------
         dict passable to ``skbio.metadata.IntervalMetadata``.
+            One dict for each input sequence in order. An empty dict is
+            yielded for the sequence that has no gene predicted unless
+            it is at the end of the input.
         '''
-        pattern = (r'# +([0-9]+)'    # start
-                   ' +# +([0-9]+)'   # end
-                   ' +# +(-?1)'      # strand
-                   ' +# +ID=([0-9]+_[0-9]+);'
-                   'partial=([01]{2});'
-                   '(.*)')
+        return FeaturePred._parse_features(*read_faa_table(faa))
+
+    @staticmethod
+    def _parse_features(table, translations=None):
+        '''Create the features from the gene table.
+
+        Parameters
+        ----------
+        table : pandas.DataFrame
+            The gene table. The partial flags and the notes are added to
+            the features only if the table has these columns.
+        translations : str, optional
+            The concatenated translations addressed by the offset and
+            length columns of the table.
+
+        Yields
+        ------
+        dict passable to ``skbio.metadata.IntervalMetadata``.
+            One dict for each input sequence in order. An empty dict is
+            yielded for the sequence that has no gene predicted unless
+            it is at the end of the input.
+        '''
+        n = len(table)
+        partial = 'left_partial' in table
+        note = 'note' in table
+        cols = [table.index, table['ordinal'].tolist(),
+                table['start'].tolist(), table['end'].tolist(),
+                table['strand'].tolist()]
+        for c, on in [('left_partial', partial), ('right_partial', partial),
+                      ('note', note)]:
+            cols.append(table[c].tolist() if on else repeat(None, n))
+        if translations is None:
+            cols.extend([repeat(None, n), repeat(None, n)])
+        else:
+            cols.extend([table['offset'].tolist(), table['length'].tolist()])
         im = dict()
         i = 1
-        for seq in read(faa, format='fasta'):
-            desc = seq.metadata['description']
-            matches = re.match(pattern, desc)
-            start, end, strand, id, partial, misc = matches.groups()
-            # ordinal number of the parent seq
-            ordinal = int(id.split('_', 1)[0])
-            if ordinal > i:
+        for (id, ordinal, start, end, strand, left, right, misc, offset,
+             length) in zip(*cols):
+            # the seqs without any gene are skipped by Prodigal
+            while ordinal > i:
                 yield im
                 # reset
                 i += 1
                 im = dict()
-            interval = []
             feature = dict()
-            feature['translation'] = str(seq)
+            if translations is not None:
+                feature['translation'] = translations[offset:offset+length]
             feature['type_'] = 'CDS'
-
-            # don't forget to convert 0-based
-            interval = [(int(start)-1, int(end))]
-            feature['note'] = '"%s"' % misc
+            if note:
+                feature['note'] = '"%s"' % misc
             feature['id'] = id
-            if partial[0] == '0':
-                feature['left_partial_'] = False
-            else:
-                feature['left_partial_'] = True
-                start = '<%s' % start
-            if partial[1] == '0':
-                feature['right_partial_'] = False
-            else:
-                feature['right_partial_'] = True
-                end = '>%s' % end
-            location = '{s}..{e}'.format(s=start, e=end)
-            if strand == '-1':
+            if partial:
+                feature['left_partial_'] = left
+                feature['right_partial_'] = right
+            # the location is 1-based
+            location = '{l}{s}..{r}{e}'.format(
+                l='<' if left else '', s=start + 1,
+                r='>' if right else '', e=end)
+            if strand == -1:
                 feature['rc_'] = True
                 location = 'complement(%s)' % location
-            elif strand == '1':
-                feature['rc_'] = False
             else:
-                raise ValueError('Inappropriate value for strand: %s' % strand)
+                feature['rc_'] = False
             feature['location'] = location
-            im[Feature(**feature)] = interval
+            im[Feature(**feature)] = [(start, end)]
 
         if im:
             # don't forget to return the last one if it is not empty.
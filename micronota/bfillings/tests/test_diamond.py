@@ -9,7 +9,7 @@
 from tempfile import mkdtemp
 from shutil import rmtree
 from os import getcwd
-from os.path import join
+from os.path import join, exists
 from unittest import TestCase, main
 
 from skbio.util import get_data_path
@@ -18,7 +18,7 @@ from burrito.util import ApplicationError
 from micronota.util import _get_named_data_path
 from micronota.bfillings.diamond import (
     DiamondMakeDB, make_db, FeatureAnnt,
-    DiamondCache)
+    DiamondCache, _filter_fasta)
 import pandas as pd
 import pandas.util.testing as pdt
 import numpy as np
@@ -73,9 +73,25 @@ class DiamondBlastTests(DiamondTests):
         for aligner, query, exp_fp in self.blast:
             pred = FeatureAnnt([self.db], mkdtemp(dir=self.tmp_dir))
             obs = pred(query, aligner=aligner)
-            exp = pred.parse_tabular(exp_fp)
+            exp = pred.parse_tabular(exp_fp).assign(partition='db')
             self.assertTrue(exp.equals(obs))
 
+    def test_blast_daa(self):
+        for aligner, query, exp_fp in self.blast:
+            out_dir = mkdtemp(dir=self.tmp_dir)
+            pred = FeatureAnnt([self.db], out_dir)
+            obs = pred(query, aligner=aligner, daa=True)
+            exp = pred.parse_tabular(exp_fp).assign(partition='db')
+            self.assertTrue(exp.equals(obs))
+            self.assertTrue(exists(join(out_dir, 'db.daa')))
+
+    def test_blast_sam(self):
+        for aligner, query, exp_fp in self.blast:
+            pred = FeatureAnnt([self.db], mkdtemp(dir=self.tmp_dir))
+            obs = pred(query, aligner=aligner, outfmt='sam')
+            exp = pred.parse_tabular(exp_fp)
+            self.assertEqual(exp['sseqid'].tolist(), obs['sseqid'].tolist())
+
     def test_blast_wrong_input(self):
         pred = FeatureAnnt([self.db], self.tmp_dir)
         for i in self.neg_fp:
@@ -94,7 +110,8 @@ class TestDiamondCache(DiamondTests):
             (tests[0], get_data_path(tests[1]),
              _get_named_data_path('%s.diamond' % tests[1]))
         seqs = skbio.read(_get_named_data_path('cache.faa'), format='fasta')
-        self.cache = DiamondCache(list(seqs))
+        self.cache = DiamondCache(list(seqs), out_dir=self.tmp_dir)
+        self.cache.build()
 
     def test_cache(self):
         np.random.seed(0)
@@ -114,6 +131,143 @@ class TestDiamondCache(DiamondTests):
         exp = pred.parse_tabular(exp_fp)
         self.assertEquals(exp['sseqid'].values, obs['sseqid'].values)
 
+    def test_cache_persist(self):
+        aligner, query, exp_fp = self.blast
+        pred = FeatureAnnt([self.db], mkdtemp(dir=self.tmp_dir),
+                           cache=self.cache)
+        pred(query, aligner=aligner)
+        self.cache.close()
+        cache = DiamondCache(out_dir=self.tmp_dir)
+        self.assertEqual(len(cache), len(self.cache))
+        self.assertEqual([str(i) for i in cache.seqs],
+                         [str(i) for i in self.cache.seqs])
+        cache.build()
+        # not re-indexed again as nothing has changed
+        self.assertFalse(DiamondCache(out_dir=self.tmp_dir)._dirty)
+
+    def test_cache_hit(self):
+        aligner, query, _ = self.blast
+        pred = FeatureAnnt([self.db], mkdtemp(dir=self.tmp_dir),
+                           cache=self.cache)
+        obs = pred(query, aligner=aligner)
+        self.assertEqual(obs['sseqid'].tolist(), ['UniRef100_P47599'])
+        self.assertIsNone(obs['partition'].iloc[0])
+        self.assertTrue(np.isnan(obs['evalue'].iloc[0]))
+
+    def test_cache_stand_in(self):
+        aligner, query, _ = self.blast
+        for min_identity, exp in [(100, ['UniRef100_P47599']), (101, [])]:
+            cache = DiamondCache(out_dir=mkdtemp(dir=self.tmp_dir),
+                                 min_identity=min_identity)
+            cache.build()
+            self.assertFalse(cache.indexed)
+            pred = FeatureAnnt([self.db], mkdtemp(dir=self.tmp_dir),
+                               cache=cache)
+            pred(query, aligner=aligner)
+            self.assertEqual([i.metadata['id'] for i in cache.seqs], exp)
+            # the new entries are searched from the next run on
+            self.assertFalse(cache.indexed)
+
+
+class DiamondCacheTests(DiamondTests):
+    def setUp(self):
+        super().setUp()
+        self.seqs = [skbio.Sequence('MKL' * i, {'id': 's%d' % i})
+                     for i in range(1, 5)]
+
+    def test_update(self):
+        cache = DiamondCache(self.seqs[:2], out_dir=self.tmp_dir)
+        cache.update(self.seqs[1:3])
+        self.assertEqual([i.metadata['id'] for i in cache.seqs],
+                         ['s3', 's2', 's1'])
+
+    def test_evict_lru(self):
+        cache = DiamondCache(self.seqs[:3], maxSize=3, out_dir=self.tmp_dir)
+        cache.touch(['s1'])
+        cache.update(self.seqs[3:])
+        self.assertNotIn('s2', cache)
+        self.assertEqual(len(cache), 3)
+
+    def test_evict_lfu(self):
+        cache = DiamondCache(self.seqs[:3], maxSize=3, out_dir=self.tmp_dir,
+                             policy='lfu')
+        cache.touch(['s1', 's1', 's3'])
+        cache.touch(['s2'])
+        cache.update(self.seqs[3:])
+        self.assertNotIn('s4', cache)
+        self.assertIn('s2', cache)
+
+    def test_close(self):
+        cache = DiamondCache(self.seqs, out_dir=self.tmp_dir)
+        cache.touch(['s2'])
+        cache.close()
+        obs = DiamondCache(out_dir=self.tmp_dir)
+        self.assertEqual([i.metadata['id'] for i in obs.seqs],
+                         ['s2', 's4', 's3', 's1'])
+        self.assertTrue(obs._dirty)
+
+    def test_policy(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown eviction policy'):
+            DiamondCache(policy='fifo')
+
+
+class FilterFastaTests(DiamondTests):
+    def test_filter_fasta(self):
+        in_fp = join(self.tmp_dir, 'in.fa')
+        out_fp = join(self.tmp_dir, 'out.fa')
+        with open(in_fp, 'w') as f:
+            f.write('>a desc\nMKL\nAA\n>b\nMMM\n>c\nKKK\n')
+        obs = _filter_fasta(in_fp, out_fp, {'b'})
+        self.assertEqual(obs, 2)
+        with open(out_fp) as f:
+            self.assertEqual(f.read(), '>a\nMKLAA\n>c\nKKK\n')
+
+    def test_filter_fasta_all(self):
+        out_fp = join(self.tmp_dir, 'out.fa')
+        fp = get_data_path('WP_009885814.faa')
+        self.assertEqual(
+            _filter_fasta(fp, out_fp, {'gi|497571630|ref|WP_009885814.1|'}),
+            0)
+
+
+class ParseTabularTests(DiamondTests):
+    def setUp(self):
+        super().setUp()
+        self.fp = join(self.tmp_dir, 'hits.diamond')
+        hits = [('q1', 's1', 50.0), ('q2', 's2', 10.0), ('q1', 's3', 60.7),
+                ('q1', 's4', 60.7), ('q2', 's5', 53.9), ('q1', 's6', 20.0)]
+        with open(self.fp, 'w') as f:
+            for q, s, b in hits:
+                f.write('%s\t%s\t90.0\t100\t1\t0\t1\t100\t1\t100\t'
+                        '1e-200\t%.1f\n' % (q, s, b))
+
+    def test_parse_tabular(self):
+        for chunksize in (1, 2, 100):
+            obs = FeatureAnnt.parse_tabular(self.fp, chunksize=chunksize)
+            self.assertEqual(obs.index.tolist(), ['q1', 'q2'])
+            self.assertEqual(obs['sseqid'].tolist(), ['s3', 's5'])
+            # the bitscores are the same as in the file
+            self.assertEqual(obs['bitscore'].tolist(), [60.7, 53.9])
+            # evalue does not underflow
+            self.assertEqual(obs['evalue'].tolist(), [1e-200, 1e-200])
+
+    def test_parse_tabular_top(self):
+        obs = FeatureAnnt.parse_tabular(self.fp, top=2, chunksize=2)
+        self.assertEqual(obs.index.tolist(), ['q1', 'q1', 'q2', 'q2'])
+        self.assertEqual(obs['sseqid'].tolist(), ['s3', 's4', 's5', 's2'])
+
+    def test_parse_tabular_ties(self):
+        obs = FeatureAnnt.parse_tabular(self.fp, ties=True, chunksize=3)
+        self.assertEqual(obs.index.tolist(), ['q1', 'q1', 'q2'])
+        self.assertEqual(obs['sseqid'].tolist(), ['s3', 's4', 's5'])
+
+    def test_parse_tabular_empty(self):
+        open(self.fp, 'w').close()
+        obs = FeatureAnnt.parse_tabular(self.fp)
+        self.assertTrue(obs.empty)
+        self.assertEqual(obs.columns.tolist(),
+                         ['sseqid', 'evalue', 'bitscore'])
+
 
 class TestParseSam(TestCase):
     def setUp(self):
@@ -175,6 +329,29 @@ class TestParseSam(TestCase):
 
             pdt.assert_frame_equal(df, exp)
 
+    def test_parse_sam_best_hit(self):
+        df = FeatureAnnt.parse_sam(self.blast[0][2], column='bitscore')
+        self.assertEqual(df.index.tolist(),
+                         ['gi|497571630|ref|WP_009885814.1|'])
+        self.assertEqual(df['sseqid'].tolist(), ['UniRef100_P47599'])
+        self.assertEqual(df['bitscore'].tolist(), [2009])
+        self.assertEqual(df['evalue'].tolist(), [2.1e-229])
+
+    def test_parse_sam_collapse(self):
+        tmp_dir = mkdtemp()
+        self.addCleanup(rmtree, tmp_dir)
+        fp = join(tmp_dir, 'hits.sam')
+        with open(fp, 'w') as f:
+            f.write('@HD\tVN:1.5\tSO:query\n')
+            for q, s, r in [('q1', 's1', 10), ('q1', 's1', 30),
+                            ('q1', 's2', 20), ('q2', 's1', 5)]:
+                f.write('%s\t0\t%s\t1\t255\t3M\t*\t0\t0\tMKL\t*\t'
+                        'ZL:i:3\tZR:i:%d\tZE:f:1e-5\tZI:i:100\tZS:i:1\n'
+                        % (q, s, r))
+        df = FeatureAnnt.parse_sam(fp, collapse=True)
+        self.assertEqual(df['sseqid'].tolist(), ['s1', 's2', 's1'])
+        self.assertEqual(df['bitscore'].tolist(), [30, 20, 5])
+
 
 if __name__ == '__main__':
     main()
@@ -6,7 +6,8 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from tempfile import mkstemp
+from tempfile import mkstemp, mkdtemp
+from shutil import rmtree
 from os import getcwd, remove, close
 from unittest import TestCase, main
 from functools import partial
@@ -16,7 +17,7 @@ from skbio.util import get_data_path
 from burrito.util import ApplicationError
 
 from micronota.bfillings.hmmer import (HMMScan, hmmscan_fasta,
-                                       hmmpress_hmm)
+                                       hmmpress_hmm, _merge_tblout)
 
 
 class HMMERTests(TestCase):
@@ -81,6 +82,42 @@ class HMMScanTests(HMMERTests):
                     [j for j in obs.readlines() if not j.startswith('#')])
             obs.close()
 
+    def test_hmmscan_fasta_shards(self):
+        for f in self.positive_fps:
+            res = hmmscan_fasta(self.hmm_fp, f, self.temp_fp, 0.1, 4,
+                                shards=3)
+            obs = res['--tblout']
+            with open('.'.join([f, 'tblout'])) as exp:
+                # the hits and E-values are the same as a single scan
+                self.assertListEqual(
+                    [i for i in exp.readlines() if not i.startswith('#')],
+                    [j for j in obs.readlines() if not j.startswith('#')])
+            obs.close()
+
+    def test_hmmscan_fasta_shards_wrong_input(self):
+        for fp in self.negative_fps:
+            with self.assertRaisesRegex(
+                    ApplicationError,
+                    r'Error: Sequence file .* is empty or misformatted'):
+                hmmscan_fasta(self.hmm_fp, fp, 'foo', shards=2)
+
+    def test_merge_tblout(self):
+        tmp_dir = mkdtemp()
+        fps = [join(tmp_dir, i) for i in ['a', 'b', 'c']]
+        for fp, hits in zip(fps, [['h1\n', 'h2\n'], [], ['h3\n']]):
+            with open(fp, 'w') as f:
+                f.write('# target\n#--- ---\n')
+                f.writelines(hits)
+                f.write('#\n# Query file: %s\n# [ok]\n' % fp)
+        out_fp = join(tmp_dir, 'out')
+        _merge_tblout(fps, out_fp)
+        with open(out_fp) as f:
+            self.assertEqual(
+                f.read(),
+                '# target\n#--- ---\nh1\nh2\nh3\n'
+                '#\n# Query file: %s\n# [ok]\n' % fps[0])
+        rmtree(tmp_dir)
+
 
 class HMMPressTests(HMMERTests):
     def test_compress_hmm(self):
@@ -123,6 +123,86 @@ class ProdigalTests(TestCase):
         for e, o in zip(self.parse_exp, obs):
             self.assertEqual(e, o)
 
+    def test_pred_parse_faa_gap(self):
+        # the 2nd seq has no gene predicted
+        fp = _get_named_data_path('parse_test_gap.faa')
+        pred = FeaturePred(None, self.tmp_dir)
+        obs = list(pred._parse_faa(fp))
+        self.assertEqual(len(obs), 3)
+        self.assertEqual(obs[0], self.parse_exp[0])
+        self.assertEqual(obs[1], {})
+        self.assertEqual([i['id'] for i in obs[2]], ['3_1'])
+
+    def test_pred_run_no_nucl(self):
+        fp = self.positive_fps[0]
+        pred = FeaturePred(None, self.tmp_dir)
+        res = pred.run(fp, {'-p': 'meta', '-f': 'sco'}, nucl=False)
+        self.assertEqual(res['ExitStatus'], 0)
+        self.assertEqual(sorted(listdir(self.tmp_dir))[:2],
+                         ['NC_018498_partial_1.faa',
+                          'NC_018498_partial_1.sco'])
+        self.assertNotIn('-d', res)
+        res['StdOut'].close()
+        res['StdErr'].close()
+
+    def test_pred_outputs(self):
+        fp = self.positive_fps[0]
+        obs_d = join(self.tmp_dir, 'obs')
+        pred = FeaturePred(None, obs_d)
+        obs = list(pred(fp, params={'-p': 'meta'}))
+        self.assertEqual(sorted(listdir(obs_d)),
+                         ['NC_018498_partial_1.faa',
+                          'NC_018498_partial_1.sco'])
+        # the other outputs are turned on by the params
+        exp_d = join(self.tmp_dir, 'exp')
+        pred = FeaturePred(None, exp_d)
+        exp = list(pred(fp, params={'-p': 'meta', '-f': 'gbk', '-d': None}))
+        self.assertEqual(obs, exp)
+        for f in listdir(exp_d):
+            self.assertTrue(cmp(join(exp_d, f),
+                                join(_get_named_data_path('test_1'), f),
+                                shallow=False))
+
+    def test_pred_run_parallel(self):
+        # the nucleotide sequences of 31 genes as input
+        fp = join(_get_named_data_path('test_3'), 'NC_018498_partial_2.fna')
+        exp_d = join(self.tmp_dir, 'exp')
+        obs_d = join(self.tmp_dir, 'obs')
+        for params in [{'-p': 'meta'}, {'-p': 'meta', '-f': 'gff'}]:
+            exp = FeaturePred(None, exp_d).run(fp, params)
+            obs = FeaturePred(None, obs_d).run_parallel(fp, 3, params)
+            for i in ['-a', '-d', '-o']:
+                self.assertEqual(obs[i].read(), exp[i].read())
+                obs[i].close()
+                exp[i].close()
+            exp['StdOut'].close()
+            exp['StdErr'].close()
+
+    def test_pred_train(self):
+        fp = self.positive_fps[2]
+        training_dir = join(self.tmp_dir, 'training')
+        training_fp = join(training_dir, 'taxon.trn')
+        pred = FeaturePred(None, join(self.tmp_dir, 'obs'))
+        self.assertEqual(pred.train(fp, training_fp), training_fp)
+        self.assertEqual(listdir(training_dir), ['taxon.trn'])
+        # it is reused by its name for another genome
+        with open(training_fp, 'rb') as f:
+            exp = f.read()
+        self.assertEqual(pred.train(self.positive_fps[0], training_fp),
+                         training_fp)
+        with open(training_fp, 'rb') as f:
+            self.assertEqual(f.read(), exp)
+        # the prediction with the training file is the same
+        params = {'-p': 'single', '-t': training_fp}
+        res = pred.run(fp, params)
+        f = 'NC_018498_partial_2.faa'
+        self.assertTrue(cmp(join(self.tmp_dir, 'obs', f),
+                            join(_get_named_data_path('test_3'), f),
+                            shallow=False))
+        for v in res.values():
+            if hasattr(v, 'close'):
+                v.close()
+
     def tearDown(self):
         # remove the tempdir and contents
         rmtree(self.tmp_dir)
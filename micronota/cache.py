@@ -0,0 +1,246 @@
+r'''
+Result Cache
+============
+
+.. currentmodule:: micronota.cache
+
+This module (:mod:`micronota.cache`) provides an on-disk cache for the
+results of the wrapped tools. The results are keyed by the content of
+their input (eg the hash of a sequence) together with the tool, its
+version, the database, and the parameters, so the same sequence
+submitted again is not re-processed by the tool.
+
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from os import stat
+from os.path import exists
+from sqlite3 import connect
+from hashlib import md5
+from functools import lru_cache
+from contextlib import contextmanager, closing
+from subprocess import Popen, PIPE
+from time import time
+import pickle
+import re
+
+
+# the commands to print the version of each tool
+_VERSION_COMMANDS = {
+    'prodigal': ['prodigal', '-v'],
+    'diamond': ['diamond', 'version'],
+    'hmmer': ['hmmscan', '-h'],
+    'infernal': ['cmscan', '-h'],
+    'minced': ['minced', '--version']}
+
+# the banner of HMMER and Infernal, eg "# HMMER 3.1b2 (February 2015); ..."
+_BANNER = re.compile(r'^# (HMMER|INFERNAL) (\S+)', re.M)
+
+
+@lru_cache()
+def tool_version(tool):
+    '''Return the version string of the tool.
+
+    Parameters
+    ----------
+    tool : str
+        The name of the module in ``micronota.bfillings``.
+
+    Returns
+    -------
+    str
+        The version found in the output of the tool (see
+        ``_parse_version``), or an empty string if it can't be found.
+    '''
+    cmd = _VERSION_COMMANDS.get(tool)
+    if cmd is None:
+        return ''
+    try:
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        out, err = proc.communicate()
+    except OSError:
+        return ''
+    return _parse_version(tool, out + err)
+
+
+def _parse_version(tool, output):
+    '''Find the version of the tool in its output.
+
+    Parameters
+    ----------
+    tool : str
+        The name of the module in ``micronota.bfillings``.
+    output : str
+        The output of the version command of the tool.
+
+    Returns
+    -------
+    str
+        The program name and version in the banner of HMMER and
+        Infernal, otherwise the first line that mentions a version or
+        starts with the tool name. An empty string if neither is found.
+    '''
+    m = _BANNER.search(output)
+    if m is not None:
+        return ' '.join(m.groups())
+    for line in output.splitlines():
+        if 'version' in line.lower() or line.lower().startswith(tool):
+            return line.strip()
+    return ''
+
+
+def file_version(fps):
+    '''Return the path, size and modification time of each file.
+
+    It is used to identify the version of the database files.
+    '''
+    version = []
+    for fp in fps:
+        if fp is not None and exists(fp):
+            st = stat(fp)
+            version.append((fp, st.st_size, st.st_mtime))
+        else:
+            version.append((fp, None, None))
+    return version
+
+
+class ResultCache:
+    '''Size-bounded on-disk cache with LRU eviction.
+
+    The values are pickled and stored in a SQLite database file. A
+    connection is opened for each operation, so the object can be
+    passed to and shared between processes.
+
+    Parameters
+    ----------
+    fp : str
+        The SQLite database file.
+    max_size : int
+        The maximal total size in bytes of the cached values. The
+        least recently used values are evicted beyond it.
+    '''
+    _table = 'results'
+    # the max number of SQL variables in a single statement
+    _chunk = 500
+
+    def __init__(self, fp, max_size=2**30):
+        self.fp = fp
+        self.max_size = max_size
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS {t} (
+                                key   TEXT  PRIMARY KEY,
+                                value BLOB  NOT NULL,
+                                size  INT   NOT NULL,
+                                used  REAL  NOT NULL);'''.format(
+                                    t=self._table))
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS used ON {t} (used);'.format(
+                    t=self._table))
+
+    @contextmanager
+    def _connect(self):
+        '''Open a connection, commit the changes and close it.'''
+        with closing(connect(self.fp, timeout=600)) as conn, conn:
+            yield conn
+
+    @staticmethod
+    def key(*args):
+        '''Return the key for the args.
+
+        Parameters
+        ----------
+        args : objects with stable ``repr``
+            eg the hash of the input sequence, the tool name, the tool
+            version, the database version, and the sorted parameters.
+        '''
+        return md5(repr(args).encode()).hexdigest()
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def get_many(self, keys):
+        '''Return the cached values of the keys.
+
+        Parameters
+        ----------
+        keys : iterable of str
+
+        Returns
+        -------
+        dict
+            The keys that are found in the cache and their values.
+        '''
+        keys = list(keys)
+        found = {}
+        with self._connect() as conn:
+            for i in range(0, len(keys), self._chunk):
+                chunk = keys[i:i + self._chunk]
+                holders = ','.join('?' * len(chunk))
+                cursor = conn.execute(
+                    'SELECT key, value FROM {t} WHERE key IN ({h});'.format(
+                        t=self._table, h=holders), chunk)
+                for k, v in cursor:
+                    found[k] = pickle.loads(v)
+                conn.execute(
+                    'UPDATE {t} SET used = ? WHERE key IN ({h});'.format(
+                        t=self._table, h=holders), [time()] + chunk)
+        return found
+
+    def put_many(self, items):
+        '''Cache the values and evict the least recently used ones.
+
+        Parameters
+        ----------
+        items : dict
+            The keys and their values to cache.
+        '''
+        now = time()
+        rows = []
+        for k, v in items.items():
+            v = pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((k, v, len(v), now))
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO {t} (key, value, size, used) '
+                'VALUES (?,?,?,?);'.format(t=self._table), rows)
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total, = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM {t};'.format(
+                t=self._table)).fetchone()
+        if total <= self.max_size:
+            return
+        evict = []
+        for k, size in conn.execute(
+                'SELECT key, size FROM {t} ORDER BY used;'.format(
+                    t=self._table)):
+            if total <= self.max_size:
+                break
+            evict.append((k,))
+            total -= size
+        conn.executemany(
+            'DELETE FROM {t} WHERE key = ?;'.format(t=self._table), evict)
+
+    def __len__(self):
+        with self._connect() as conn:
+            n, = conn.execute(
+                'SELECT COUNT(*) FROM {t};'.format(t=self._table)).fetchone()
+        return n
+
+    def __contains__(self, key):
+        with self._connect() as conn:
+            found = conn.execute(
+                'SELECT 1 FROM {t} WHERE key = ?;'.format(t=self._table),
+                (key,)).fetchone()
+        return found is not None
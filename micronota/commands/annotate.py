@@ -6,9 +6,12 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from os.path import abspath
+
 import click
 
 from ..workflow import annotate
+from ..service import submit
 
 
 @click.command()
@@ -26,16 +29,76 @@ from ..workflow import annotate
               help='Output format for the annotated sequences.')
 @click.option('--cpus', type=int, default=1,
               help='Number of CPUs to use.')
+@click.option('--processes', type=int, default=None,
+              help=('Number of batches of sequences to annotate in parallel. '
+                    'By default, it is decided from --cpus.'))
+@click.option('--batch_size', type=int, default=1,
+              help=('Number of input sequences to process in one batch. '
+                    'Set it to 0 to process all the sequences at once.'))
+@click.option('--pipeline', is_flag=True,
+              help=('Overlap the feature identification of a batch with the '
+                    'CDS annotation of the previous one.'))
+@click.option('--cache_dir', type=click.Path(file_okay=False),
+              default=None,
+              help=('Directory to cache the results of the tools, so they '
+                    'are reused for identical sequences in later runs.'))
+@click.option('--cache_size', type=int, default=1024,
+              help='Maximal size (MB) of the result cache.')
+@click.option('--merged_db', is_flag=True,
+              help=('Search the merged UniRef database in one pass instead '
+                    'of its partitions one after another.'))
+@click.option('--hit_qualifiers', is_flag=True,
+              help=('Add the e-value, bitscore and database partition of '
+                    'the hits to the annotated CDS.'))
+@click.option('--no_intermediates', is_flag=True,
+              help=('Remove the intermediate files of each batch once it is '
+                    'written instead of keeping them in the output dir.'))
+@click.option('--scratch_dir', type=click.Path(exists=True, file_okay=False),
+              default=None,
+              help=('Directory for the intermediate files with '
+                    '--no_intermediates. Default to the system temp dir.'))
+@click.option('--hit_table', is_flag=True,
+              help='Write the hits of all the CDS to one table.')
+@click.option('--training_file', type=click.Path(dir_okay=False),
+              default=None,
+              help=('Prodigal training file for the single mode, eg one per '
+                    'taxon. It is trained on the first batch and saved if it '
+                    'does not exist. Use --batch_size 0 to train it on the '
+                    'whole genome.'))
 @click.option('--kingdom',
               type=click.Choice(['Bacteria', 'Archaea', 'Viruses']),
               default='Bacteria',
               help='Kingdom of the input sequence organism.')
 @click.option('--force', is_flag=True,
               help='Force overwrite if the output directory exists')
+@click.option('--resume', is_flag=True,
+              help=('Resume the previous run in the output directory and '
+                    'skip the sequences already annotated.'))
+@click.option('--server', type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help=('Socket of a running "micronota serve" to submit the '
+                    'job to. It runs with the configuration of the server.'))
 @click.pass_context
 def cli(ctx, input_fp, in_fmt, output_dir, out_fmt,
-        cpus, kingdom, force):
+        cpus, processes, batch_size, pipeline, cache_dir, cache_size,
+        merged_db, hit_qualifiers, no_intermediates, scratch_dir, hit_table,
+        training_file, kingdom, force, resume, server):
     '''Annotate prokaryotic genomes.'''
-    annotate(input_fp, in_fmt, output_dir, out_fmt,
-             cpus, kingdom, force,
-             ctx.parent.config)
+    kwargs = dict(processes=processes, batch_size=batch_size,
+                  pipeline=pipeline, resume=resume, cache_dir=cache_dir,
+                  cache_size=cache_size, merged_db=merged_db,
+                  hit_qualifiers=hit_qualifiers,
+                  keep_intermediates=not no_intermediates,
+                  scratch_dir=scratch_dir, hit_table=hit_table,
+                  training_file=training_file)
+    if server is None:
+        annotate(input_fp, in_fmt, output_dir, out_fmt,
+                 cpus, kingdom, force, ctx.parent.config, **kwargs)
+    else:
+        # the server may run in a different working directory
+        for k in ['cache_dir', 'scratch_dir', 'training_file']:
+            if kwargs[k] is not None:
+                kwargs[k] = abspath(kwargs[k])
+        submit(server, in_fp=abspath(input_fp), in_fmt=in_fmt,
+               out_dir=abspath(output_dir), out_fmt=out_fmt, cpus=cpus,
+               kingdom=kingdom, force=force, **kwargs)
@@ -31,8 +31,12 @@ def cli(ctx):
                     'do not need to be downloaded again if it exists there.'))
 @click.option('-f', '--force', is_flag=True,
               help='Force overwrite.')
+@click.option('--merge', is_flag=True,
+              help=('Also create the merged UniRef database for '
+                    '"micronota annotate --merged_db". It doubles the '
+                    'disk usage of UniRef.'))
 @click.pass_context
-def create_db(ctx, databases, cache_dir, force):
+def create_db(ctx, databases, cache_dir, force, merge):
     '''Prepare database.
 
     Download the files for the specified DATABASES and manipulate
@@ -47,4 +51,7 @@ def create_db(ctx, databases, cache_dir, force):
         f = getattr(submodule, func_name)
         out_d = join(config.db_dir, d)
         makedirs(out_d, exist_ok=True)
-        f(out_d, cache_dir, force=force)
+        kwargs = {'force': force}
+        if d.startswith('uniref'):
+            kwargs['merge'] = merge
+        f(out_d, cache_dir, **kwargs)
@@ -0,0 +1,33 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import click
+
+from ..service import AnnotationServer
+
+
+@click.command()
+@click.option('-s', '--socket_fp', type=click.Path(dir_okay=False),
+              required=True,
+              help='Path of the Unix socket to listen on.')
+@click.option('--workers', type=int, default=1,
+              help='Number of annotation jobs to run in parallel.')
+@click.pass_context
+def cli(ctx, socket_fp, workers):
+    '''Serve annotation jobs on a local socket.
+
+    The jobs are submitted with "micronota annotate --server" and run
+    with the configuration of this server.'''
+    server = AnnotationServer(socket_fp, ctx.parent.config, workers)
+    click.echo('Serving on %s.' % socket_fp)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
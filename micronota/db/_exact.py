@@ -0,0 +1,246 @@
+r'''
+Exact Match Index
+=================
+
+.. currentmodule:: micronota.db._exact
+
+This module indexes protein sequences by the hash of their sequence, so
+the query proteins identical to a reference protein are resolved by a
+binary search instead of a homology search.
+
+The index consists of three numpy arrays saved side by side:
+
+* ``<prefix>_digest.npy``: the sorted 64-bit digests of the sequences.
+
+* ``<prefix>_id.npy``: the sequence IDs in the same order.
+
+* ``<prefix>_partition.npy``: the partition code of each sequence.
+
+A sequence is indexed once for each partition it occurs in, so it can
+be looked up in the partition that a homology search would pick.
+
+They are memory mapped when loaded, so opening even a huge index is
+instant and only the pages touched by the lookups are read.
+
+The index is written with ``IndexWriter``, which spools the IDs and the
+partition codes to disk as they come, so building it for UniRef100 only
+holds the digests and their sort order in memory.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from os import remove
+from os.path import exists
+from hashlib import md5
+from array import array
+from itertools import islice
+
+import numpy as np
+
+
+def seq_digest(seq):
+    '''Return the 64-bit digest of a protein sequence.
+
+    The case and the trailing stop codon ("*") are ignored.
+
+    Parameters
+    ----------
+    seq : str
+        The protein sequence.
+
+    Returns
+    -------
+    int
+    '''
+    seq = seq.upper().rstrip('*')
+    return int.from_bytes(md5(seq.encode()).digest()[:8], 'little')
+
+
+def _fps(prefix):
+    return ['%s_%s.npy' % (prefix, i) for i in ['digest', 'id', 'partition']]
+
+
+def _unique_order(digests, partitions):
+    '''Return the positions of the unique sequences of each partition.
+
+    The positions are sorted by the digest and then by the partition
+    code. Of the sequences with the same digest in the same partition,
+    the first one is picked.
+    '''
+    if len(digests) == 0:
+        return np.array([], dtype=np.intp)
+    # the sort is stable, so the first of the duplicates comes first
+    order = np.lexsort((partitions, digests))
+    d = digests[order]
+    p = partitions[order]
+    new = np.ones(len(d), dtype=bool)
+    new[1:] = (d[1:] != d[:-1]) | (p[1:] != p[:-1])
+    return order[new]
+
+
+class IndexWriter():
+    '''Write the exact match index one sequence at a time.
+
+    The IDs and the partition codes are written to temporary files
+    beside the index as they are added. Only the digests are kept in
+    memory to be sorted, and the IDs are copied into the index in
+    chunks.
+
+    Parameters
+    ----------
+    prefix : str
+        The path prefix of the index files.
+    chunksize : int
+        The number of IDs copied at a time.
+    '''
+    def __init__(self, prefix, chunksize=2**20):
+        self.prefix = prefix
+        self.chunksize = chunksize
+        self._digests = array('Q')
+        self._id_fp = '%s_id.tmp' % prefix
+        self._partition_fp = '%s_partition.tmp' % prefix
+        self._ids = open(self._id_fp, 'wb', buffering=2**20)
+        self._partitions = open(self._partition_fp, 'wb', buffering=2**20)
+        self._width = 1
+
+    def add(self, digest, id, partition):
+        '''Add a sequence to the index.
+
+        Parameters
+        ----------
+        digest : int
+            The digest (from ``seq_digest``) of the sequence.
+        id : str
+            The sequence ID.
+        partition : int
+            The partition code of the sequence. If a sequence occurs
+            more than once in a partition, the first one is kept.
+        '''
+        id = id.encode()
+        self._digests.append(digest)
+        self._ids.write(id + b'\n')
+        self._partitions.write(bytes((partition,)))
+        if len(id) > self._width:
+            self._width = len(id)
+
+    def close(self):
+        '''Sort the sequences and write the index files.'''
+        self._ids.close()
+        self._partitions.close()
+        digests = np.frombuffer(self._digests, dtype=np.uint64)
+        partitions = np.fromfile(self._partition_fp, dtype=np.uint8)
+        keep = _unique_order(digests, partitions)
+        digest_fp, id_fp, partition_fp = _fps(self.prefix)
+        np.save(digest_fp, digests[keep])
+        np.save(partition_fp, partitions[keep])
+        del digests, partitions
+        dtype = 'S%d' % self._width
+        if len(keep) == 0:
+            np.save(id_fp, np.array([], dtype=dtype))
+        else:
+            # a fixed-width copy of the IDs to pick them by position
+            fixed_fp = '%s_id.fixed.tmp' % self.prefix
+            fixed = np.memmap(fixed_fp, dtype=dtype, mode='w+',
+                              shape=(len(self._digests),))
+            with open(self._id_fp, 'rb') as f:
+                i = 0
+                while True:
+                    lines = [j.rstrip(b'\n')
+                             for j in islice(f, self.chunksize)]
+                    if not lines:
+                        break
+                    fixed[i:i + len(lines)] = lines
+                    i += len(lines)
+            out = np.lib.format.open_memmap(
+                id_fp, mode='w+', dtype=dtype, shape=(len(keep),))
+            for i in range(0, len(keep), self.chunksize):
+                out[i:i + self.chunksize] = fixed[keep[i:i + self.chunksize]]
+            out.flush()
+            del out, fixed
+            remove(fixed_fp)
+        remove(self._id_fp)
+        remove(self._partition_fp)
+        self._digests = array('Q')
+
+
+def write_index(prefix, digests, ids, partitions):
+    '''Write the exact match index.
+
+    Parameters
+    ----------
+    prefix : str
+        The path prefix of the index files.
+    digests : iterable of int
+        The digests (from ``seq_digest``) of the sequences.
+    ids : iterable of str
+        The sequence IDs.
+    partitions : iterable of int
+        The partition code of each sequence. If a sequence occurs
+        more than once in a partition, the first one is kept.
+    '''
+    writer = IndexWriter(prefix)
+    for digest, id, partition in zip(digests, ids, partitions):
+        writer.add(digest, id, partition)
+    writer.close()
+
+
+def index_exists(prefix):
+    '''Check whether the exact match index exists.'''
+    return all(exists(fp) for fp in _fps(prefix))
+
+
+class ExactIndex():
+    '''Look up protein sequences in the exact match index.
+
+    Parameters
+    ----------
+    prefix : str
+        The path prefix of the index files written by ``write_index``.
+    '''
+    def __init__(self, prefix):
+        self.digests, self.ids, self.partitions = [
+            np.load(fp, mmap_mode='r') for fp in _fps(prefix)]
+
+    def __len__(self):
+        return len(self.digests)
+
+    def lookup(self, seqs, partition=None):
+        '''Find the reference sequences identical to the queries.
+
+        Parameters
+        ----------
+        seqs : dict of str
+            The protein sequences keyed by their IDs.
+        partition : int or None
+            The code of the partition to find them in. If it is None,
+            the identical sequence in the partition of the smallest
+            code is picked.
+
+        Returns
+        -------
+        dict
+            The ID and the partition code of the identical reference
+            sequence for each query found in the index.
+        '''
+        qids = list(seqs)
+        if not qids or not len(self):
+            return {}
+        keys = np.fromiter((seq_digest(seqs[i]) for i in qids),
+                           dtype=np.uint64, count=len(qids))
+        start = np.searchsorted(self.digests, keys, side='left')
+        end = np.searchsorted(self.digests, keys, side='right')
+        res = {}
+        for i in np.flatnonzero(end > start):
+            # the rows of a digest are sorted by the partition code
+            for j in range(start[i], end[i]):
+                code = int(self.partitions[j])
+                if partition is None or code == partition:
+                    res[qids[i]] = (self.ids[j].decode(), code)
+                    break
+        return res
@@ -91,13 +91,18 @@ from skbio import read, Sequence
 
 from ..util import _overwrite, _download
 from ..bfillings.diamond import make_db
+from ._exact import seq_digest, IndexWriter
 
 
 _status = ['Swiss-Prot', 'TrEMBL']
 _kingdom = ['Bacteria', 'Archaea', 'Viruses', 'Eukaryota', 'other']
+# the partitions of UniRef; the index is the code in the partition table
+_partitions = ['%s_%s' % (i, j) for i, j in product(_status, _kingdom)]
+_partitions.append('_other')
 
 
-def _prepare(downloaded, out_d, uniref_url, resolution, force=False):
+def _prepare(downloaded, out_d, uniref_url, resolution, force=False,
+             merge=False):
     '''Prepare reference database for UniRef.
 
     Parameters
@@ -111,6 +116,9 @@ def _prepare(downloaded, out_d, uniref_url, resolution, force=False):
         50, 90, 100
     force : boolean
         Force overwrite the files
+    merge : boolean
+        Whether to also create the merged database of all the partitions
+        to search them in a single pass. It doubles the disk usage.
 
     Notes
     -----
@@ -129,6 +137,14 @@ def _prepare(downloaded, out_d, uniref_url, resolution, force=False):
     * ``_other.dmnd``
 
     * ``uniprotkb.db``
+
+    * ``exact_digest.npy``, ``exact_id.npy`` and ``exact_partition.npy``,
+      the exact match index
+
+    and if ``merge`` is True:
+
+    * ``merged.dmnd``
+    * ``partition.db``
     '''
     if resolution not in {50, 90, 100}:
         raise ValueError('UniRef resolution must be 50, 90, or 100.')
@@ -143,7 +159,8 @@ def _prepare(downloaded, out_d, uniref_url, resolution, force=False):
 
     _prepare_metadata(metadata_db, downloaded, force=force)
 
-    sort_uniref(metadata_db, uniref_raw, fasta_out, resolution, force)
+    sort_uniref(metadata_db, uniref_raw, fasta_out, resolution, force,
+                merge=merge)
 
 
 def _prepare_metadata(
@@ -164,7 +181,8 @@ def _prepare_metadata(
     create_metadata([sprot_raw, trembl_raw], metadata_db)
 
 
-def sort_uniref(db_fp, uniref_fp, out_d, resolution, force=False):
+def sort_uniref(db_fp, uniref_fp, out_d, resolution, force=False,
+                merge=False, exact=True):
     '''Sort UniRef sequences into different partitions.
 
     This will sort UniRef100 seq into following partitions based on both
@@ -182,6 +200,14 @@ def sort_uniref(db_fp, uniref_fp, out_d, resolution, force=False):
     * ``uniref100/TrEMBL_Eukaryota.fasta``
     * ``uniref100/_other.fasta``
 
+    If ``merge`` is True, all the sequences are also written into
+    ``merged.fasta`` and the partition of each of them is recorded in
+    ``partition.db``, so they can be searched in a single pass (see
+    ``lookup_partition``).
+
+    If ``exact`` is True, the sequences are also hashed into the exact
+    match index ``exact`` (see ``micronota.db._exact``).
+
     Parameters
     ----------
     db_fp : str
@@ -190,15 +216,29 @@ def sort_uniref(db_fp, uniref_fp, out_d, resolution, force=False):
         The UniRef100 fasta file. gzipped or not.
     out_d : str
         The output directory to place the resulting fasta files.
+    merge : bool
+        Whether to create the merged database and its partition table.
+    exact : bool
+        Whether to create the exact match index.
     '''
     _overwrite(out_d, force)
     makedirs(out_d)
     logger = getLogger(__name__)
     logger.info('Sorting UniRef sequences')
-    fns = ['%s_%s' % (i, j) for i, j in product(_status, _kingdom)]
-    fns.append('_other')
+    fns = _partitions
     fps = [join(out_d, 'uniref%d_%s.fasta' % (resolution, f)) for f in fns]
     files = {fn: open(fp, 'w') for fp, fn in zip(fps, fns)}
+    if merge:
+        merged_fp = join(out_d, 'merged.fasta')
+        merged = open(merged_fp, 'w')
+        fps.append(merged_fp)
+        lookup = connect(join(out_d, 'partition.db'))
+        lookup.execute('''CREATE TABLE partition (
+                              id         TEXT  PRIMARY KEY,
+                              partition  INT   NOT NULL);''')
+    code = {fn: i for i, fn in enumerate(fns)}
+    if exact:
+        index = IndexWriter(join(out_d, 'exact'))
 
     with connect(db_fp) as conn:
         cursor = conn.cursor()
@@ -212,16 +252,59 @@ def sort_uniref(db_fp, uniref_fp, out_d, resolution, force=False):
             for _, s, k in cursor.fetchall():
                 group[0] = _status[s]
                 group[1] = _kingdom[k]
-            seq.write(files['_'.join(group)])
+            fn = '_'.join(group)
+            seq.write(files[fn])
+            if merge:
+                seq.write(merged)
+                lookup.execute(
+                    'INSERT INTO partition (id, partition) VALUES (?,?);',
+                    (id, code[fn]))
+            if exact:
+                index.add(seq_digest(str(seq)), id, code[fn])
 
     for f in files:
         files[f].close()
+    if merge:
+        merged.close()
+        lookup.commit()
+        lookup.close()
+    if exact:
+        index.close()
     for fp in fps:
         # if the fasta file is not empty
         if stat(fp).st_size > 0:
             make_db(fp)
 
 
+def lookup_partition(db_fp, ids):
+    '''Look up the partitions of UniRef sequences.
+
+    Parameters
+    ----------
+    db_fp : str
+        The partition table ``partition.db`` created by ``sort_uniref``.
+    ids : iterable of str
+        The UniRef IDs.
+
+    Returns
+    -------
+    dict
+        The partition name (e.g. "Swiss-Prot_Bacteria") of each ID. The
+        IDs absent from the table are left out.
+    '''
+    ids = list(ids)
+    partitions = {}
+    with connect(db_fp) as conn:
+        # stay below the limit of the number of SQL variables
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cursor = conn.execute(
+                'SELECT id, partition FROM partition WHERE id IN (%s)' %
+                ','.join('?' * len(chunk)), chunk)
+            partitions.update((id, _partitions[p]) for id, p in cursor)
+    return partitions
+
+
 def create_metadata(in_fps, db_fp, force=False):
     '''
     Parameters
@@ -0,0 +1,78 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from os import listdir
+from os.path import join
+from tempfile import mkdtemp
+from shutil import rmtree
+from unittest import TestCase, main
+
+from micronota.db._exact import (
+    seq_digest, write_index, index_exists, ExactIndex, IndexWriter)
+
+
+class ExactIndexTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.prefix = join(self.tmp_dir, 'exact')
+        seqs = ['MKLV', 'MAAA', 'MKLV', 'MGGG']
+        write_index(self.prefix, [seq_digest(i) for i in seqs],
+                    ['UniRef100_A', 'UniRef100_B', 'UniRef100_C',
+                     'UniRef100_D'],
+                    [5, 0, 1, 10])
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_seq_digest(self):
+        self.assertEqual(seq_digest('MKLV'), seq_digest('mklv*'))
+        self.assertNotEqual(seq_digest('MKLV'), seq_digest('MKLA'))
+
+    def test_index_exists(self):
+        self.assertTrue(index_exists(self.prefix))
+        self.assertFalse(index_exists(join(self.tmp_dir, 'foo')))
+
+    def test_lookup(self):
+        index = ExactIndex(self.prefix)
+        # the duplicate sequence is kept in both of its partitions
+        self.assertEqual(len(index), 4)
+        seqs = {'q1': 'MKLV*', 'q2': 'MKL', 'q3': 'MGGG', 'q4': 'WWWW'}
+        self.assertEqual(index.lookup(seqs),
+                         {'q1': ('UniRef100_C', 1),
+                          'q3': ('UniRef100_D', 10)})
+        self.assertEqual(index.lookup(seqs, partition=5),
+                         {'q1': ('UniRef100_A', 5)})
+        self.assertEqual(index.lookup(seqs, partition=0), {})
+
+    def test_index_writer(self):
+        prefix = join(self.tmp_dir, 'chunked')
+        # the IDs are copied in several chunks
+        writer = IndexWriter(prefix, chunksize=2)
+        seqs = ['MKLV', 'MAAA', 'MKLV', 'MGGG', 'MAAA', 'MWWW']
+        for i, (seq, p) in enumerate(zip(seqs, [5, 3, 1, 10, 3, 0])):
+            writer.add(seq_digest(seq), 'UniRef100_%d' % i, p)
+        writer.close()
+        self.assertEqual(sorted(listdir(self.tmp_dir)),
+                         ['chunked_digest.npy', 'chunked_id.npy',
+                          'chunked_partition.npy', 'exact_digest.npy',
+                          'exact_id.npy', 'exact_partition.npy'])
+        obs = ExactIndex(prefix).lookup(dict(zip('abcd', seqs)))
+        self.assertEqual(obs, {'a': ('UniRef100_2', 1),
+                               'b': ('UniRef100_1', 3),
+                               'c': ('UniRef100_2', 1),
+                               'd': ('UniRef100_3', 10)})
+
+    def test_lookup_empty(self):
+        self.assertEqual(ExactIndex(self.prefix).lookup({}), {})
+        prefix = join(self.tmp_dir, 'empty')
+        write_index(prefix, [], [], [])
+        self.assertEqual(ExactIndex(prefix).lookup({'q1': 'MKLV'}), {})
+
+
+if __name__ == '__main__':
+    main()
@@ -12,9 +12,13 @@ from tempfile import mkdtemp
 from unittest import main
 from shutil import rmtree
 
+from skbio import read
+
 from micronota.util import _DBTest, _get_named_data_path
-from micronota.db._uniref import create_metadata, sort_uniref
+from micronota.db._uniref import (
+    create_metadata, sort_uniref, lookup_partition)
 from micronota.db.uniref100 import prepare_db
+from micronota.db._exact import ExactIndex
 
 
 class UnirefTests(_DBTest):
@@ -60,10 +64,31 @@ class UnirefTests(_DBTest):
                     remove(obs)
 
     def test_sort_uniref(self):
-        sort_uniref(self.exp_db_fp, self.uniref_fp,
-                    join(self.tmp_dir, 'uniref100'), 100)
+        out_d = join(self.tmp_dir, 'uniref100')
+        sort_uniref(self.exp_db_fp, self.uniref_fp, out_d, 100)
+        # the merged database is optional
+        self.assertFalse(exists(join(out_d, 'merged.fasta')))
         self._test_eq()
 
+    def test_sort_uniref_merged(self):
+        out_d = join(self.tmp_dir, 'uniref100')
+        sort_uniref(self.exp_db_fp, self.uniref_fp, out_d, 100, merge=True)
+        self.assertTrue(exists(join(out_d, 'merged.dmnd')))
+        ids = [seq.metadata['id'] for seq in
+               read(join(out_d, 'merged.fasta'), format='fasta')]
+        obs = lookup_partition(join(out_d, 'partition.db'), ids)
+        self.assertEqual(sorted(obs), sorted(ids))
+        self.assertTrue(set(obs.values()).issubset(self.uniref_res))
+
+    def test_sort_uniref_exact(self):
+        out_d = join(self.tmp_dir, 'uniref100')
+        sort_uniref(self.exp_db_fp, self.uniref_fp, out_d, 100, merge=True)
+        seqs = {seq.metadata['id']: str(seq) for seq in
+                read(join(out_d, 'merged.fasta'), format='fasta')}
+        obs = ExactIndex(join(out_d, 'exact')).lookup(seqs)
+        self.assertEqual({i: obs[i][0] for i in obs},
+                         {i: i for i in seqs})
+
     def test_prepare_db(self):
         prepare_db(self.d, self.tmp_dir)
         self._test_eq()
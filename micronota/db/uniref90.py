@@ -13,8 +13,8 @@ from ._uniref import _prepare
 
 def prepare_db(downloaded, out_d='uniref',
                uniref_url='ftp://ftp.uniprot.org/pub/databases/uniprot/uniref/uniref90/uniref90.fasta.gz',
-               force=False):
+               force=False, merge=False):
     logger = getLogger(__name__)
     logger.info('Preparing UniRef90 database')
 
-    _prepare(downloaded, out_d, uniref_url, 90, force)
+    _prepare(downloaded, out_d, uniref_url, 90, force, merge)
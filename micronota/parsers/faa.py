@@ -0,0 +1,142 @@
+r'''
+Prodigal Protein FASTA Parser
+=============================
+
+.. currentmodule:: micronota.parsers.faa
+
+Prodigal writes the protein translation of each predicted gene in
+FASTA format with the coordinates of the gene in the header line::
+
+    >NC_018498.1_1 # 686 # 1828 # 1 # ID=1_1;partial=00;start_type=ATG;...
+
+The fields separated by "#" are the start, the end and the strand of
+the gene, followed by the gene ID (the ordinal number of the input
+sequence and of the gene on it), whether the gene runs off the left and
+the right edges of the sequence, and the other gene scores.
+
+This module reads the file in large blocks and extracts the fields with
+one precompiled pattern into a columnar gene table, without creating
+a sequence or a feature object for each gene.
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+
+import numpy as np
+import pandas as pd
+
+
+_HEADER = re.compile(
+    rb'^>\S*'
+    rb' +# +([0-9]+)'           # start
+    rb' +# +([0-9]+)'           # end
+    rb' +# +(-?1)'              # strand
+    rb' +# +ID=([0-9]+)_([0-9]+);'
+    rb'partial=([01])([01]);'
+    rb'([^\r\n]*)\r?$', re.M)
+
+
+def _read_blocks(f, blocksize):
+    '''Yield the blocks of complete records from a binary file.'''
+    rest = b''
+    while True:
+        chunk = f.read(blocksize)
+        if not chunk:
+            break
+        block = rest + chunk
+        # cut after the last complete record
+        cut = block.rfind(b'\n>')
+        if cut == -1:
+            rest = block
+        else:
+            rest = block[cut+1:]
+            yield block[:cut+1]
+    if rest:
+        yield rest
+
+
+def read_faa_table(faa, blocksize=2**22):
+    '''Read the faa output of Prodigal into a gene table.
+
+    Parameters
+    ----------
+    faa : str or file object
+        The faa file path or its opened file.
+    blocksize : int
+        The number of bytes read at a time.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per gene in the order of the file, indexed by the gene
+        ID. The columns are the ordinal of the input sequence, the
+        ordinal of the gene on it, the 0-based start and end, the strand
+        (1 or -1), the left and right partial flags, the other fields of
+        the header, and the offset and length of its translation.
+    str
+        The concatenated translations of all the genes.
+
+    Raises
+    ------
+    ValueError
+        If a header line is not in the format of Prodigal.
+    '''
+    if isinstance(faa, str):
+        f = open(faa, 'rb')
+    else:
+        # read the bytes underneath the text file
+        f = getattr(faa, 'buffer', faa)
+    cols = [[] for _ in range(8)]
+    seqs = []
+    offset = 0
+    offsets = []
+    try:
+        for block in _read_blocks(f, blocksize):
+            matches = list(_HEADER.finditer(block))
+            n = block.count(b'\n>') + block.startswith(b'>')
+            if len(matches) != n:
+                raise ValueError(
+                    'Found %d record(s) not in Prodigal format.' % (
+                        n - len(matches)))
+            ends = [m.start() for m in matches[1:]] + [len(block)]
+            for m, end in zip(matches, ends):
+                for col, v in zip(cols, m.groups()):
+                    col.append(v)
+                seq = block[m.end():end].replace(b'\n', b'').replace(
+                    b'\r', b'')
+                seqs.append(seq)
+                offsets.append(offset)
+                offset += len(seq)
+    finally:
+        if isinstance(faa, str):
+            f.close()
+
+    start, end, strand, ordinal, gene, left, right, note = cols
+    # the numeric fields are converted in bulk instead of one by one
+    ordinal = np.array(ordinal, dtype=bytes).astype(np.int64)
+    gene = np.array(gene, dtype=bytes).astype(np.int64)
+    table = pd.DataFrame({
+        'ordinal': ordinal,
+        'gene': gene,
+        # convert to 0-based
+        'start': np.array(start, dtype=bytes).astype(np.int64) - 1,
+        'end': np.array(end, dtype=bytes).astype(np.int64),
+        'strand': np.array(strand, dtype=bytes).astype(np.int8),
+        'left_partial': np.array(left, dtype=bytes) == b'1',
+        'right_partial': np.array(right, dtype=bytes) == b'1',
+        'note': [i.decode() for i in note],
+        'offset': np.array(offsets, dtype=np.int64),
+        'length': np.array([len(i) for i in seqs], dtype=np.int64)},
+        columns=['ordinal', 'gene', 'start', 'end', 'strand',
+                 'left_partial', 'right_partial', 'note',
+                 'offset', 'length'],
+        index=pd.Index(['%d_%d' % i for i in zip(ordinal, gene)],
+                       name='id'))
+    return table, b''.join(seqs).decode()
@@ -0,0 +1,61 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from io import BytesIO
+
+import pandas as pd
+import pandas.util.testing as pdt
+from skbio.util import get_data_path
+
+from micronota.parsers.faa import read_faa_table
+
+
+class ReadFaaTableTests(TestCase):
+    def setUp(self):
+        self.fp = get_data_path('prodigal.faa')
+        self.exp = pd.DataFrame(
+            [[1, 1, 685, 1828, 1, False, False,
+              'start_type=ATG;gc_cont=0.236', 0, 81],
+             [1, 2, 1827, 2757, -1, False, True,
+              'start_type=Edge;gc_cont=0.271', 81, 19],
+             [3, 1, 0, 552, 1, True, False,
+              'start_type=Edge;gc_cont=0.272', 100, 12]],
+            columns=['ordinal', 'gene', 'start', 'end', 'strand',
+                     'left_partial', 'right_partial', 'note',
+                     'offset', 'length'],
+            index=pd.Index(['1_1', '1_2', '3_1'], name='id'))
+        self.exp['strand'] = self.exp['strand'].astype('int8')
+
+    def test_read_faa_table(self):
+        # the small block size splits the records across the blocks
+        for blocksize in [7, 100, 2**22]:
+            table, seqs = read_faa_table(self.fp, blocksize)
+            pdt.assert_frame_equal(table, self.exp)
+            self.assertEqual(seqs[81:100], 'MNLYDLLELPTTASIKEIK')
+            self.assertEqual(seqs[100:], 'MKKTSPFILRR*')
+            self.assertEqual(len(seqs), 112)
+
+    def test_read_faa_table_file(self):
+        with open(self.fp) as f:
+            table, _ = read_faa_table(f)
+        pdt.assert_frame_equal(table, self.exp)
+
+    def test_read_faa_table_empty(self):
+        table, seqs = read_faa_table(BytesIO())
+        self.assertEqual(len(table), 0)
+        self.assertEqual(seqs, '')
+
+    def test_read_faa_table_wrong_header(self):
+        f = BytesIO(b'>a # 1 # 3 # 1 # ID=1_1;partial=00;\nM\n>b foo\nM\n')
+        with self.assertRaisesRegex(ValueError, '1 record'):
+            read_faa_table(f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+r'''
+Annotation Service
+==================
+
+.. currentmodule:: micronota.service
+
+This module (:mod:`micronota.service`) runs micronota as a long-lived
+local service. The server listens on a Unix socket and runs the
+annotation jobs submitted by the clients in a pool of worker processes
+that stay alive across jobs, so the jobs are queued and run with the
+configuration of the server. The wrapped tools (eg DIAMOND) are still
+launched and load their databases for every job.
+
+A job is a JSON object of the keyword arguments of
+:func:`micronota.workflow.annotate`, sent on a single line. The server
+replies with a single line of JSON object once the job is finished.
+The socket is only accessible to the user running the server.
+
+'''
+
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from os import remove, chmod
+from os.path import exists
+from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+import socket
+import json
+
+from .workflow import annotate
+
+
+# the keyword arguments of ``annotate`` a job may set
+_JOB_KEYS = {
+    'in_fp', 'in_fmt', 'out_dir', 'out_fmt', 'cpus', 'kingdom', 'force',
+    'processes', 'batch_size', 'pipeline', 'resume', 'cache_dir',
+    'cache_size', 'merged_db', 'hit_qualifiers', 'keep_intermediates',
+    'scratch_dir', 'hit_table', 'training_file'}
+
+
+class _Handler(StreamRequestHandler):
+    '''Run a job and reply with its status.'''
+    def handle(self):
+        logger = getLogger(__name__)
+        try:
+            job = json.loads(self.rfile.readline().decode())
+            logger.info('Received job: %r' % job)
+            unknown = set(job) - _JOB_KEYS
+            if unknown:
+                raise ValueError('Unknown job option(s): %s.' % ', '.join(
+                    sorted(unknown)))
+            future = self.server.pool.submit(_run, job, self.server.config)
+            future.result()
+            reply = {'status': 'done'}
+        except Exception as e:
+            logger.exception('Job failed')
+            reply = {'status': 'failed',
+                     'message': '%s: %s' % (type(e).__name__, e)}
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+def _run(job, config):
+    annotate(config=config, **job)
+
+
+class AnnotationServer(ThreadingMixIn, UnixStreamServer):
+    '''Serve annotation jobs on a Unix socket.
+
+    Parameters
+    ----------
+    socket_fp : str
+        The path of the socket file.
+    config : ``micronota.config.Configuration``
+        The configuration used for all the jobs.
+    workers : int
+        The number of jobs to run in parallel.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_fp, config, workers=1):
+        super().__init__(socket_fp, _Handler)
+        self.socket_fp = socket_fp
+        self.config = config
+        self.pool = ProcessPoolExecutor(workers)
+
+    def server_bind(self):
+        super().server_bind()
+        # the jobs may overwrite any file of the user
+        chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+        if exists(self.socket_fp):
+            remove(self.socket_fp)
+
+
+def submit(socket_fp, **job):
+    '''Submit a job to the server and wait for it to finish.
+
+    Parameters
+    ----------
+    socket_fp : str
+        The path of the socket file of the server.
+    job : dict
+        The keyword arguments of ``micronota.workflow.annotate``, except
+        ``config``. The file paths should be absolute.
+
+    Raises
+    ------
+    RuntimeError
+        If the job failed on the server.
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_fp)
+        with s.makefile('rwb') as f:
+            f.write((json.dumps(job) + '\n').encode())
+            f.flush()
+            reply = json.loads(f.readline().decode())
+    if reply['status'] != 'done':
+        raise RuntimeError('Job failed on the server: %s' % reply['message'])
@@ -0,0 +1,104 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+import pickle
+
+from micronota.cache import ResultCache, file_version, _parse_version
+
+
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.fp = join(self.tmp, 'results.db')
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_key(self):
+        k1 = ResultCache.key('abc', ('prodigal', '2.6.2'))
+        k2 = ResultCache.key('abc', ('prodigal', '2.6.3'))
+        self.assertEqual(k1, ResultCache.key('abc', ('prodigal', '2.6.2')))
+        self.assertNotEqual(k1, k2)
+
+    def test_get_put(self):
+        cache = ResultCache(self.fp)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 1), 1)
+        cache.put('a', {'sseqid': 'UniRef100_P47599'})
+        cache.put('b', None)
+        self.assertEqual(cache.get('a'), {'sseqid': 'UniRef100_P47599'})
+        self.assertIn('b', cache)
+        self.assertNotIn('c', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_persistent(self):
+        ResultCache(self.fp).put_many({'a': 1, 'b': 2})
+        cache = ResultCache(self.fp)
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2})
+
+    def test_get_many_chunks(self):
+        cache = ResultCache(self.fp)
+        items = {str(i): i for i in range(1200)}
+        cache.put_many(items)
+        self.assertEqual(cache.get_many(items), items)
+
+    def test_evict(self):
+        size = len(pickle.dumps('x' * 100, protocol=pickle.HIGHEST_PROTOCOL))
+        cache = ResultCache(self.fp, max_size=size * 2)
+        cache.put('a', 'x' * 100)
+        cache.put('b', 'x' * 100)
+        # use 'a' so 'b' becomes the least recently used
+        cache.get('a')
+        cache.put('c', 'x' * 100)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+
+class ParseVersionTests(TestCase):
+    def test_parse_version(self):
+        outputs = [
+            ('prodigal', '\nProdigal V2.6.3: February, 2016\n\n',
+             'Prodigal V2.6.3: February, 2016'),
+            ('diamond', 'diamond version 0.8.36\n',
+             'diamond version 0.8.36'),
+            ('hmmer',
+             '# hmmscan :: search sequence(s) against a profile database\n'
+             '# HMMER 3.1b2 (February 2015); http://hmmer.org/\n'
+             '# Copyright (C) 2015 Howard Hughes Medical Institute.\n',
+             'HMMER 3.1b2'),
+            ('infernal',
+             '# cmscan :: search sequence(s) against a CM database\n'
+             '# INFERNAL 1.1.2 (July 2016)\n'
+             '# Copyright (C) 2016 Howard Hughes Medical Institute.\n',
+             'INFERNAL 1.1.2'),
+            ('minced', 'unknown\n', '')]
+        for tool, output, exp in outputs:
+            self.assertEqual(_parse_version(tool, output), exp)
+
+
+class FileVersionTests(TestCase):
+    def test_file_version(self):
+        tmp = mkdtemp()
+        fp = join(tmp, 'db.dmnd')
+        with open(fp, 'w') as f:
+            f.write('abc')
+        obs = file_version([fp, join(tmp, 'missing'), None])
+        self.assertEqual(obs[0][:2], (fp, 3))
+        self.assertEqual(obs[1], (join(tmp, 'missing'), None, None))
+        self.assertEqual(obs[2], (None, None, None))
+        rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
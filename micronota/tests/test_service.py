@@ -0,0 +1,55 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import stat
+from os.path import join, exists
+from threading import Thread
+import stat as st
+
+from micronota.service import submit, AnnotationServer
+from micronota.config import Configuration
+
+
+class AnnotationServerTests(TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.socket_fp = join(self.tmp, 'micronota.sock')
+        self.server = AnnotationServer(self.socket_fp, Configuration())
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        rmtree(self.tmp)
+
+    def test_submit_failed(self):
+        with self.assertRaisesRegex(RuntimeError, r'TypeError'):
+            submit(self.socket_fp, in_fp='foo.fna')
+
+    def test_submit_unknown(self):
+        with self.assertRaisesRegex(RuntimeError,
+                                    r'Unknown job option\(s\): config, foo'):
+            submit(self.socket_fp, foo=1, config='bar')
+
+    def test_socket_mode(self):
+        self.assertEqual(st.S_IMODE(stat(self.socket_fp).st_mode), 0o600)
+
+    def test_server_close(self):
+        self.assertTrue(exists(self.socket_fp))
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertFalse(exists(self.socket_fp))
+
+
+if __name__ == '__main__':
+    main()
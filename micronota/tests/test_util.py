@@ -0,0 +1,72 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, micronota development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+
+from micronota.util import _read_fasta, _write_fasta, _split_fasta
+
+
+class FastaTests(TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.fp = join(self.tmp, 'seqs.fa')
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_write_fasta(self):
+        _write_fasta(self.fp, [('a', 'MKL'), ('b', 'MAA')])
+        with open(self.fp) as f:
+            self.assertEqual(f.read(), '>a\nMKL\n>b\nMAA\n')
+
+    def test_write_fasta_empty(self):
+        _write_fasta(self.fp, [])
+        with open(self.fp) as f:
+            self.assertEqual(f.read(), '')
+
+    def test_read_fasta(self):
+        with open(self.fp, 'w') as f:
+            f.write('>a desc\nMKL\nAA\n\n>b\n>c\nKKK\n')
+        self.assertEqual(list(_read_fasta(self.fp)),
+                         [('a', 'MKLAA'), ('b', ''), ('c', 'KKK')])
+
+    def test_roundtrip(self):
+        records = [('1_%d' % i, 'MK' * i) for i in range(1, 100)]
+        _write_fasta(self.fp, iter(records))
+        self.assertEqual(list(_read_fasta(self.fp)), records)
+
+    def test_split_fasta(self):
+        with open(self.fp, 'w') as f:
+            f.write('>a desc\nAAAA\nAA\n>b\nCCCC\n>c\nGG\n'
+                    '>d\nTTTTTTTT\n>e\n')
+        prefix = join(self.tmp, 'chunk')
+        obs = _split_fasta(self.fp, 3, prefix)
+        self.assertEqual([i[1] for i in obs], [1, 2, 2])
+        self.assertEqual([i[0] for i in obs],
+                         ['%s_%d.fasta' % (prefix, i) for i in range(3)])
+        with open(obs[0][0]) as f:
+            self.assertEqual(f.read(), '>a desc\nAAAA\nAA\n')
+        with open(obs[2][0]) as f:
+            self.assertEqual(f.read(), '>d\nTTTTTTTT\n>e\n')
+
+    def test_split_fasta_few(self):
+        with open(self.fp, 'w') as f:
+            f.write('>a\nAAAA\n>b\nC\n')
+        # a long record takes the place of several chunks
+        self.assertEqual(
+            [i[1] for i in _split_fasta(self.fp, 4, join(self.tmp, 'c'))],
+            [1, 1])
+        open(self.fp, 'w').close()
+        self.assertEqual(_split_fasta(self.fp, 4, join(self.tmp, 'c')), [])
+
+
+if __name__ == '__main__':
+    main()
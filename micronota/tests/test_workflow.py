@@ -7,15 +7,27 @@
 # ----------------------------------------------------------------------------
 
 from unittest import TestCase, main
+import re
 from os.path import join, abspath
+from os import makedirs, listdir
+from threading import active_count
+from contextlib import closing
 from tempfile import mkdtemp
 from shutil import rmtree
 from filecmp import cmp
+from sqlite3 import connect
 
-from skbio import read, write
+from skbio import read, write, Sequence
 from skbio.util import get_data_path
+from skbio.metadata import Feature
+import pandas as pd
 
-from micronota.workflow import annotate
+from micronota.workflow import (
+    annotate, _batch, _schedule, _pipeline, _skip_done, _write_record,
+    _renumber, _resolve_partition, _get_uniref_db, _write_cds, _fan_out,
+    _update, _hit_map, _start_hits, _append_hits, _whole_input,
+    _name_batches)
+from micronota.db._uniref import lookup_partition
 from micronota.config import Configuration
 
 
@@ -39,6 +51,16 @@ class TestAnnotate(TestCase):
         with open(self.test1, 'w') as f:
             for seq in read(files[1], format='fasta'):
                 write(seq, format='fasta', into=f)
+        # several contigs in one file, one of which has no CDS
+        self.test2 = join(self.tmp, 'test2.fna')
+        with open(self.test2, 'w') as f:
+            for seq in read(files[0], format='fasta'):
+                write(seq, format='fasta', into=f)
+            # stop codons in all the frames on both strands
+            write(Sequence('CTAG' * 50, {'id': 'no_cds'}),
+                  format='fasta', into=f)
+            for seq in read(files[1], format='fasta'):
+                write(seq, format='fasta', into=f)
 
         self.obs_tmp = mkdtemp()
 
@@ -66,6 +88,362 @@ class TestAnnotate(TestCase):
             join(self.obs_tmp, self.test1_exp),
             shallow=False))
 
+    def test_annotate_parallel(self):
+        config = Configuration()
+        config.db_dir = self.test_dir
+        annotate(self.test1, 'fasta', self.obs_tmp, 'genbank',
+                 2, 'archaea', True, config, cache=False, processes=2)
+        self.assertTrue(cmp(
+            get_data_path(self.test1_exp),
+            join(self.obs_tmp, self.test1_exp),
+            shallow=False))
+
+    def test_annotate_batch(self):
+        config = Configuration()
+        config.db_dir = self.test_dir
+        annotate(self.test1, 'fasta', self.obs_tmp, 'genbank',
+                 1, 'archaea', True, config, cache=False, batch_size=0)
+        self.assertTrue(cmp(
+            get_data_path(self.test1_exp),
+            join(self.obs_tmp, self.test1_exp),
+            shallow=False))
+
+    def test_annotate_pipeline(self):
+        config = Configuration()
+        config.db_dir = self.test_dir
+        annotate(self.test1, 'fasta', self.obs_tmp, 'genbank',
+                 2, 'archaea', True, config, pipeline=True)
+        self.assertTrue(cmp(
+            get_data_path(self.test1_exp),
+            join(self.obs_tmp, self.test1_exp),
+            shallow=False))
+
+    def _annotate_contigs(self, name, cpus=1, **kwargs):
+        config = Configuration()
+        config.db_dir = self.test_dir
+        out_dir = join(self.obs_tmp, name)
+        annotate(self.test2, 'fasta', out_dir, 'genbank',
+                 cpus, 'archaea', True, config, cache=False, **kwargs)
+        with open(join(out_dir, 'test2.genbank')) as f:
+            return f.read().split('//\n')[:-1]
+
+    def test_annotate_contigs(self):
+        # each contig on its own
+        exp = self._annotate_contigs('exp')
+        self.assertEqual(len(exp), 4)
+        self.assertNotIn(' CDS ', exp[2])
+        for name, kwargs in [('batch', {'batch_size': 0}),
+                             ('batch_3', {'batch_size': 3}),
+                             ('parallel', {'batch_size': 2,
+                                           'processes': 2, 'cpus': 2}),
+                             ('pipeline', {'batch_size': 2,
+                                           'pipeline': True, 'cpus': 2})]:
+            obs = self._annotate_contigs(name, **kwargs)
+            # the features are split back to their contigs in order
+            self.assertEqual(
+                [re.sub(r'/id=\d+_', '/id=', i) for i in obs],
+                [re.sub(r'/id=\d+_', '/id=', i) for i in exp], name)
+            # and numbered by the position of the contig in the batch
+            size = kwargs['batch_size'] or len(obs)
+            for i, record in enumerate(obs):
+                ids = set(re.findall(r'/id=(\d+)_', record))
+                self.assertLessEqual(ids, {str(i % size + 1)}, name)
+
+    def test_annotate_resume(self):
+        config = Configuration()
+        config.db_dir = self.test_dir
+        annotate(self.test1, 'fasta', self.obs_tmp, 'genbank',
+                 1, 'archaea', True, config)
+        # nothing is left to annotate
+        annotate(self.test1, 'fasta', self.obs_tmp, 'genbank',
+                 1, 'archaea', False, config, resume=True)
+        self.assertTrue(cmp(
+            get_data_path(self.test1_exp),
+            join(self.obs_tmp, self.test1_exp),
+            shallow=False))
+        with open(join(self.obs_tmp, 'test1.manifest')) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_annotate_result_cache(self):
+        config = Configuration()
+        config.db_dir = self.test_dir
+        cache_dir = join(self.tmp, 'cache')
+        for i in range(2):
+            # the 2nd run is served from the cache
+            annotate(self.test1, 'fasta', self.obs_tmp, 'genbank',
+                     1, 'archaea', True, config, cache_dir=cache_dir)
+            self.assertTrue(cmp(
+                get_data_path(self.test1_exp),
+                join(self.obs_tmp, self.test1_exp),
+                shallow=False))
+
+    def test_annotate_scratch(self):
+        config = Configuration()
+        config.db_dir = self.test_dir
+        scratch_dir = join(self.tmp, 'scratch')
+        makedirs(scratch_dir)
+        annotate(self.test1, 'fasta', self.obs_tmp, 'genbank',
+                 1, 'archaea', True, config, keep_intermediates=False,
+                 scratch_dir=scratch_dir, hit_table=True)
+        self.assertTrue(cmp(
+            get_data_path(self.test1_exp),
+            join(self.obs_tmp, self.test1_exp),
+            shallow=False))
+        self.assertEqual(sorted(listdir(self.obs_tmp)),
+                         ['test1.genbank', 'test1.hits', 'test1.manifest'])
+        self.assertEqual(listdir(scratch_dir), [])
+
+
+class TestHitTable(TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.fp = join(self.tmp, 'test.hits')
+        self.batch_fp = join(self.tmp, 'hits.tsv')
+        with open(self.batch_fp, 'w') as f:
+            f.write('id\tsseqid\tevalue\tbitscore\n'
+                    '1_1\ta\t0.0\t\n'
+                    '2_3\tb\t1e-05\t50.0\n')
+        self.seqs = [Sequence('ACGT', {'id': 'contig1'}),
+                     Sequence('ACGT', {'id': 'contig2'})]
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_append_hits(self):
+        _start_hits(self.fp, set())
+        _append_hits(self.fp, self.batch_fp, self.seqs)
+        _append_hits(self.fp, join(self.tmp, 'foo.tsv'), self.seqs)
+        with open(self.fp) as f:
+            self.assertEqual(
+                f.read(),
+                'seq_id\tid\tsseqid\tevalue\tbitscore\tpartition\n'
+                'contig1\t1_1\ta\t0.0\t\t\n'
+                'contig2\t2_3\tb\t1e-05\t50.0\t\n')
+
+    def test_start_hits_resume(self):
+        _start_hits(self.fp, set())
+        _append_hits(self.fp, self.batch_fp, self.seqs)
+        _start_hits(self.fp, {'contig2'})
+        with open(self.fp) as f:
+            self.assertEqual(
+                f.read(),
+                'seq_id\tid\tsseqid\tevalue\tbitscore\tpartition\n'
+                'contig2\t2_3\tb\t1e-05\t50.0\t\n')
+
+
+class TestWriteCds(TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_write_cds(self):
+        im = [Feature(type_='CDS', id='1_1', translation='MKL'),
+              Feature(type_='CDS', id='1_2', translation='MAA'),
+              Feature(type_='tRNA', id='1_3', translation='MKL'),
+              Feature(type_='CDS', id='2_1', translation='MKL')]
+        fp = join(self.tmp, 'cds.fa')
+        obs = _write_cds(fp, im, 'id')
+        self.assertEqual(obs, {'1_1': ['1_1', '2_1'], '1_2': ['1_2']})
+        with open(fp) as f:
+            self.assertEqual(f.read(), '>1_1\nMKL\n>1_2\nMAA\n')
+
+    def test_fan_out(self):
+        res = pd.DataFrame({'sseqid': ['a', 'b']}, index=['1_1', '1_2'])
+        obs = _fan_out(res, {'1_1': ['1_1', '2_1'], '1_2': ['1_2']})
+        self.assertEqual(obs.index.tolist(), ['1_1', '2_1', '1_2'])
+        self.assertEqual(obs['sseqid'].tolist(), ['a', 'a', 'b'])
+
+
+class TestUpdate(TestCase):
+    def setUp(self):
+        self.im = {Feature(type_='CDS', id='1_1'): [(0, 9)],
+                   Feature(type_='CDS', id='1_2'): [(3, 6)]}
+        self.res = pd.DataFrame(
+            {'sseqid': ['a', 'b', 'c'], 'evalue': [0.0, 1e-5, 1e-3],
+             'bitscore': [float('nan'), 50.0, 20.0],
+             'partition': ['Swiss-Prot_Bacteria', None, None]},
+            index=['1_1', '1_2', '1_2'])
+
+    def test_update(self):
+        obs = _update(self.im, 'id', _hit_map(self.res))
+        exp = {Feature(type_='CDS', id='1_1', db_xref='a'): [(0, 9)],
+               Feature(type_='CDS', id='1_2', db_xref='b'): [(3, 6)]}
+        self.assertEqual(obs, exp)
+
+    def test_update_qualifiers(self):
+        obs = _update(self.im, 'id', _hit_map(self.res), qualifiers=True)
+        exp = {Feature(type_='CDS', id='1_1', db_xref='a', evalue=0.0,
+                       partition='Swiss-Prot_Bacteria'): [(0, 9)],
+               Feature(type_='CDS', id='1_2', db_xref='b', evalue=1e-5,
+                       bitscore=50.0): [(3, 6)]}
+        self.assertEqual(obs, exp)
+
+    def test_update_no_hit(self):
+        exp = dict(self.im)
+        self.assertEqual(_update(self.im, 'id', _hit_map(pd.DataFrame())),
+                         exp)
+
+
+class TestRenumber(TestCase):
+    def test_renumber(self):
+        im = {Feature(type_='CDS', id='1_2'): [(0, 9)],
+              Feature(type_='CDS', id='foo'): [(3, 6)]}
+        exp = {Feature(type_='CDS', id='3_2'): [(0, 9)],
+               Feature(type_='CDS', id='foo'): [(3, 6)]}
+        self.assertEqual(_renumber(im, 3), exp)
+        self.assertEqual(_renumber(exp, 3), exp)
+
+
+class TestWholeInput(TestCase):
+    def test_whole_input(self):
+        self.assertTrue(_whole_input('prodigal', None))
+        self.assertTrue(_whole_input('prodigal', {'-p': 'single'}))
+        self.assertFalse(_whole_input('prodigal', {'-p': 'meta'}))
+        self.assertFalse(_whole_input('minced', None))
+
+
+class TestResolvePartition(TestCase):
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.partition_fp = join(self.tmp, 'partition.db')
+        with connect(self.partition_fp) as conn:
+            conn.execute('''CREATE TABLE partition (
+                              id         TEXT  PRIMARY KEY,
+                              partition  INT   NOT NULL);''')
+            # Swiss-Prot_Bacteria, TrEMBL_Bacteria and Swiss-Prot_Archaea
+            conn.executemany(
+                'INSERT INTO partition (id, partition) VALUES (?,?);',
+                [('sp_bac', 0), ('tr_bac', 5), ('sp_arc', 1)])
+        self.hits = pd.DataFrame(
+            {'sseqid': ['tr_bac', 'sp_arc', 'sp_bac', 'tr_bac', 'unknown'],
+             'evalue': [1e-50, 1e-40, 1e-30, 1e-5, 1e-5],
+             'bitscore': [200.0, 150.0, 100.0, 50.0, 50.0]},
+            index=['a', 'a', 'a', 'b', 'c'],
+            columns=['sseqid', 'evalue', 'bitscore'])
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_lookup_partition(self):
+        obs = lookup_partition(self.partition_fp, ['sp_arc', 'x', 'tr_bac'])
+        self.assertEqual(obs, {'sp_arc': 'Swiss-Prot_Archaea',
+                               'tr_bac': 'TrEMBL_Bacteria'})
+
+    def test_resolve_partition(self):
+        for kingdom, exp in [('bacteria', ['sp_bac', 'tr_bac']),
+                             ('archaea', ['sp_arc', 'tr_bac'])]:
+            obs = _resolve_partition(self.hits, self.partition_fp,
+                                     _get_uniref_db(kingdom))
+            self.assertEqual(obs.index.tolist(), ['a', 'b'])
+            self.assertEqual(obs['sseqid'].tolist(), exp)
+
+    def test_resolve_partition_empty(self):
+        obs = _resolve_partition(self.hits.iloc[:0], self.partition_fp,
+                                 _get_uniref_db('bacteria'))
+        self.assertTrue(obs.empty)
+
+
+class TestSkipDone(TestCase):
+    def setUp(self):
+        self.seqs = [Sequence('ACGT' * i, {'id': str(i)})
+                     for i in range(1, 5)]
+        self.tmp = mkdtemp()
+        self.manifest = join(self.tmp, 'manifest')
+        with open(join(self.tmp, 'out'), 'w') as out, \
+                open(self.manifest, 'w') as f:
+            for seq in self.seqs[:2]:
+                _write_record(seq, out, 'fasta', f)
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
+    def test_skip_done(self):
+        seqs, done = _skip_done(self.seqs, self.manifest)
+        self.assertEqual([i.metadata['id'] for i in seqs], ['3', '4'])
+        self.assertEqual([i[0] for i in done], ['1', '2'])
+
+    def test_skip_done_changed(self):
+        self.seqs[1] = Sequence('TTTT', {'id': '2'})
+        seqs, done = _skip_done(self.seqs, self.manifest)
+        self.assertEqual([i.metadata['id'] for i in seqs], ['2', '3', '4'])
+        self.assertEqual([i[0] for i in done], ['1'])
+
+
+class TestBatch(TestCase):
+    def test_batch(self):
+        seqs = [Sequence('A', {'id': str(i)}) for i in range(5)]
+        obs = [[s.metadata['id'] for s in b] for b in _batch(seqs, 2)]
+        self.assertEqual(obs, [['0', '1'], ['2', '3'], ['4']])
+
+    def test_name_batches(self):
+        seqs = [Sequence('A', {'id': i})
+                for i in ['ctg.1', 'a', 'ctg_1', 'b', 'c']]
+        obs = [i for i, _ in _name_batches(_batch(seqs, 2), 3)]
+        # the IDs of the first seqs are the same after sanitizing
+        self.assertEqual(obs, ['4_ctg_1', '6_ctg_1', '8_c'])
+
+    def test_batch_all(self):
+        seqs = [Sequence('A', {'id': str(i)}) for i in range(5)]
+        obs = list(_batch(seqs, 0))
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(len(obs[0]), 5)
+
+
+class TestSchedule(TestCase):
+    def test_schedule(self):
+        self.assertEqual(_schedule(1), (1, 1))
+        self.assertEqual(_schedule(4), (1, 4))
+        self.assertEqual(_schedule(32), (4, 8))
+        self.assertEqual(_schedule(12), (1, 12))
+        self.assertEqual(_schedule(20), (2, 10))
+
+    def test_schedule_processes(self):
+        self.assertEqual(_schedule(32, 4), (4, 8))
+        self.assertEqual(_schedule(32, 32), (32, 1))
+        # no more processes than CPUs
+        self.assertEqual(_schedule(2, 4), (2, 1))
+
+    def test_schedule_wrong_input(self):
+        with self.assertRaisesRegex(ValueError, 'CPUs'):
+            _schedule(0)
+        with self.assertRaisesRegex(ValueError, 'processes'):
+            _schedule(4, 0)
+
+
+class TestPipeline(TestCase):
+    def test_pipeline(self):
+        obs = _pipeline(range(10), [lambda x: x * 2, lambda x: x + 1], 1)
+        self.assertEqual(list(obs), [2 * i + 1 for i in range(10)])
+
+    def test_pipeline_empty(self):
+        self.assertEqual(list(_pipeline([], [lambda x: x])), [])
+
+    def test_pipeline_error(self):
+        def f(x):
+            if x == 3:
+                raise ValueError('Wrong item')
+            return x
+        with self.assertRaisesRegex(ValueError, 'Wrong item'):
+            list(_pipeline(range(10), [f, lambda x: x]))
+
+    def test_pipeline_consumer_error(self):
+        n = active_count()
+        seen = []
+
+        def f(x):
+            seen.append(x)
+            return x
+        with self.assertRaisesRegex(ValueError, 'Wrong item'):
+            with closing(_pipeline(range(100), [f], 1)) as res:
+                for i in res:
+                    if i == 3:
+                        raise ValueError('Wrong item')
+        # all the threads have finished and the rest is skipped
+        self.assertEqual(active_count(), n)
+        self.assertLess(len(seen), 100)
+
 
 if __name__ == '__main__':
     main()
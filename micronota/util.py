@@ -45,6 +45,114 @@ def _download(src, dest, **kwargs):
         shutil.copyfileobj(i_f, o_f)
 
 
+def _write_fasta(fp, records):
+    '''Write the sequences in fasta format.
+
+    This is a light-weight alternative to ``skbio.io.write`` for writing
+    plain records in bulk, eg the proteins to search with DIAMOND.
+
+    Parameters
+    ----------
+    fp : str
+        The output file path.
+    records : iterable of tuple of str
+        The ID and sequence of each record.
+    '''
+    with open(fp, 'w', buffering=2**20) as f:
+        f.writelines('>%s\n%s\n' % record for record in records)
+
+
+def _read_fasta(fp):
+    '''Read the sequences in fasta format.
+
+    The descriptions of the records are ignored.
+
+    Parameters
+    ----------
+    fp : str
+        The input file path.
+
+    Yields
+    ------
+    tuple of str
+        The ID and sequence of each record.
+    '''
+    id = None
+    seq = []
+    with open(fp, buffering=2**20) as f:
+        for line in f:
+            if line.startswith('>'):
+                if id is not None:
+                    yield id, ''.join(seq)
+                id = line[1:].split(None, 1)[0]
+                seq = []
+            elif id is not None:
+                seq.append(line.strip())
+    if id is not None:
+        yield id, ''.join(seq)
+
+
+def _split_fasta(fp, n, prefix):
+    '''Split the fasta file into chunks of about the same total length.
+
+    The records are kept intact and in order, so the records of each
+    chunk are contiguous in the input.
+
+    Parameters
+    ----------
+    fp : str
+        The input file path.
+    n : int
+        The maximal number of chunks. Fewer are written if a chunk would
+        be empty, eg for a record longer than the rest together.
+    prefix : str
+        The path prefix of the chunks, which are named as
+        "<prefix>_<i>.fasta".
+
+    Returns
+    -------
+    list of tuple
+        The file path and the number of records of each chunk.
+    '''
+    lengths = []
+    with open(fp, buffering=2**20) as f:
+        for line in f:
+            if line.startswith('>'):
+                lengths.append(0)
+            elif lengths:
+                lengths[-1] += len(line.strip())
+    total = sum(lengths)
+    # assign each record to the chunk of its midpoint; the empty
+    # records stay with the previous one
+    chunks = []
+    pos = 0
+    for i in lengths:
+        if i == 0 and chunks:
+            chunks.append(chunks[-1])
+        else:
+            chunks.append(min(n - 1, (2 * pos + i) * n // (2 * total))
+                          if total else 0)
+        pos += i
+    res = []
+    out = None
+    i = -1
+    with open(fp, buffering=2**20) as f:
+        for line in f:
+            if line.startswith('>'):
+                i += 1
+                if not res or chunks[i] != chunks[i - 1]:
+                    if out is not None:
+                        out.close()
+                    res.append(['%s_%d.fasta' % (prefix, len(res)), 0])
+                    out = open(res[-1][0], 'w', buffering=2**20)
+                res[-1][1] += 1
+            if out is not None:
+                out.write(line)
+    if out is not None:
+        out.close()
+    return [tuple(i) for i in res]
+
+
 def _get_named_data_path(fname):
     # get caller's file path
     caller_fp = abspath(stack()[1][1])
@@ -7,22 +7,45 @@
 # ----------------------------------------------------------------------------
 
 from os.path import splitext, basename, join, exists
-from os import makedirs, stat
+from os import makedirs, stat, remove
 from importlib import import_module
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
+from shutil import rmtree
 from logging import getLogger
+from multiprocessing import Pool
+from threading import Thread, Event
+from queue import Queue
+from functools import partial
+from contextlib import closing
+from hashlib import md5
+import re
+from itertools import chain, repeat, islice
 
 from skbio.metadata import IntervalMetadata
-from skbio import read, Sequence
+from skbio import read
 import pandas as pd
 
 from . import bfillings
-from .util import _overwrite
+from .util import _overwrite, _write_fasta
+from .cache import ResultCache, tool_version, file_version
+from .db._uniref import lookup_partition, _partitions
+from .db._exact import ExactIndex, index_exists
 from . bfillings.diamond import DiamondCache as dc
 
 
+# the number of threads beyond which the wrapped tools scale poorly
+_MAX_THREADS = 8
+
+# the feature ID assigned by Prodigal, ie "<ordinal>_<n>"
+_ID_PATTERN = re.compile(r'[0-9]+_[0-9]+$')
+
+
 def annotate(in_fp, in_fmt, out_dir, out_fmt,
-             cpus, kingdom, force, config, cache=False):
+             cpus, kingdom, force, config, cache=False, processes=None,
+             batch_size=1, pipeline=False, resume=False, cache_dir=None,
+             cache_size=1024, merged_db=False, hit_qualifiers=False,
+             keep_intermediates=True, scratch_dir=None, hit_table=False,
+             training_file=None):
     '''Annotate the sequences in the input file.
 
     Parameters
@@ -38,40 +61,564 @@ def annotate(in_fp, in_fmt, out_dir, out_fmt,
     kingdom : int
         Kingdom index corresponding to database (i.e. virus, bacteria ...)
     cpus : int
-        Number of cpus to use.
+        Number of cpus to use. They are split between the batches
+        annotated in parallel and the threads of each wrapped tool
+        (see ``_schedule``).
     force : boolean
         Force to overwrite.
     config : ``micronota.config.Configuration``
         Container for configuration options.
+    cache : boolean
+        Whether to search the proteins against a ``DiamondCache`` of the
+        recently hit reference proteins first. It is kept in the
+        "diamond" directory under ``cache_dir`` (or ``out_dir``).
+    processes : int or None
+        Number of batches of input sequences to annotate in parallel.
+        If it is larger than 1, the batches are distributed to a pool of
+        worker processes and the annotated records are still written
+        out in the input order. ``DiamondCache`` is not shared between
+        processes, so it is disabled in this mode. By default, it is
+        decided from ``cpus``.
+    batch_size : int
+        Number of input sequences to group into one batch. Each feature
+        prediction tool runs once per batch instead of once per
+        sequence, and so does the homology search of the proteins
+        from the batch. Set it to 0 to put all the sequences in one
+        batch.
+    pipeline : boolean
+        Whether to run feature identification and CDS annotation as
+        concurrent stages connected by bounded queues, so the
+        identification of the next batch overlaps with the homology
+        search of the current one. It runs in a single process and the
+        CPUs are split between the two stages, so it is only used with
+        at least 2 CPUs.
+    resume : boolean
+        Whether to resume from a previous run in the same output
+        directory. Each annotated record is logged in a manifest file
+        along with the hash of its sequence; the leading input
+        sequences that match the manifest are skipped and the rest of
+        them are annotated and appended to the output file.
+    cache_dir : str or None
+        The directory of the result cache. If it is given, the results
+        of the tools are cached there and reused for the identical
+        sequences in later runs.
+    cache_size : int
+        The maximal size (MB) of the result cache.
+    merged_db : boolean
+        Whether to search the proteins against the merged UniRef database
+        once instead of the partitions one after another (see
+        ``annotate_all_cds_batch``).
+    hit_qualifiers : boolean
+        Whether to add the e-value, bitscore and database partition of
+        the hits to the annotated CDS besides the hit ID.
+    keep_intermediates : boolean
+        Whether to keep the intermediate files of each batch in its
+        sub-directory of ``out_dir``. Otherwise, they are put in a
+        scratch directory and removed as soon as the annotated records
+        of the batch are written.
+    scratch_dir : str or None
+        The directory to create the scratch directory in. It defaults to
+        the system temporary directory.
+    hit_table : boolean
+        Whether to collect the hits of the CDS of all the batches into
+        one table ``<prefix>.hits`` in ``out_dir``.
+    training_file : str or None
+        The Prodigal training file for the single mode. It is reused by
+        its name, so it can be shared by related genomes, eg named after
+        their taxon. If it does not exist, it is trained on the first
+        batch and saved there; set ``batch_size`` to 0 to train it on the
+        whole genome instead of the first contig.
     '''
-    _overwrite(out_dir, overwrite=force)
-    makedirs(out_dir, exist_ok=force)
+    logger = getLogger(__name__)
+    if pipeline and processes is not None and processes > 1:
+        logger.warning('Only one process is used in the pipeline mode.')
+    if pipeline:
+        processes = 1
+    processes, threads = _schedule(cpus, processes)
+    if pipeline and threads < 2:
+        logger.warning('The pipeline mode needs at least 2 CPUs.')
+        pipeline = False
+    logger.info('Running %d process(es) with %d thread(s) each.' % (
+        processes, threads))
+    if not resume:
+        _overwrite(out_dir, overwrite=force)
+    makedirs(out_dir, exist_ok=force or resume)
     prefix = splitext(basename(in_fp))[0]
     fn = '{p}.{f}'.format(p=prefix, f=out_fmt)
     out_fp = join(out_dir, fn)
+    manifest_fp = join(out_dir, '%s.manifest' % prefix)
+    hits_fp = join(out_dir, '%s.hits' % prefix)
 
     # declare DiamondCache
-    if cache:
-        cache = dc()
+    if cache and processes > 1:
+        logger.warning('DiamondCache is disabled for parallel annotation.')
+        cache = None
+    elif cache:
+        # the cache persists across the runs sharing the cache dir
+        cache_d = join(out_dir if cache_dir is None else cache_dir,
+                       'diamond')
+        makedirs(cache_d, exist_ok=True)
+        cache = dc(out_dir=cache_d)
+        # index it once for the whole run
+        cache.build()
     else:
         cache = None
 
-    with open(out_fp, 'w') as out:
-        # cache
-        # submit slurm jobs
-        for seq in read(in_fp, format=in_fmt):
-            # dir for useful intermediate files for the current input seq
-            # replace non alnum char with "_"
-            seq_fn = ''.join(x if x.isalnum() else '_'
-                             for x in seq.metadata['id'])
-            seq_dir = join(out_dir, seq_fn)
-            # identify all features specified
-            im = identify_all_features(seq, seq_dir, config)
+    if cache_dir is None:
+        result_cache = None
+    else:
+        makedirs(cache_dir, exist_ok=True)
+        result_cache = ResultCache(
+            join(cache_dir, 'results.db'), cache_size * 2**20)
+
+    seqs = read(in_fp, format=in_fmt)
+    done = []
+    if resume and exists(manifest_fp) and exists(out_fp):
+        seqs, done = _skip_done(seqs, manifest_fp)
+        logger.info('Resuming after %d annotated sequence(s).' % len(done))
+    # the batches are named by the position and ID of their first seq
+    batches = _name_batches(_batch(seqs, batch_size), len(done))
+    if hit_table:
+        _start_hits(hits_fp, {i[0] for i in done})
+    if keep_intermediates:
+        work_dir = out_dir
+    else:
+        work_dir = mkdtemp(prefix='micronota_', dir=scratch_dir)
+    with open(out_fp, 'r+' if done else 'w') as out, \
+            open(manifest_fp, 'w') as manifest:
+        # discard the partially written records after the last done one
+        for entry in done:
+            manifest.write('\t'.join(entry) + '\n')
+        if done:
+            out.seek(int(done[-1][-1]))
+            out.truncate()
+
+        def write(batch):
+            name, seqs = batch
+            for seq in seqs:
+                _write_record(seq, out, out_fmt, manifest)
+            batch_dir = join(work_dir, name)
+            if hit_table:
+                _append_hits(hits_fp, join(batch_dir, 'hits.tsv'), seqs)
+            if not keep_intermediates:
+                rmtree(batch_dir, ignore_errors=True)
+
+        opts = _Options(cache, result_cache, merged_db, hit_qualifiers,
+                        training_file, hit_table)
+        try:
+            _run(batches, write, work_dir, processes, threads, pipeline,
+                 kingdom, config, opts)
+        finally:
+            if cache is not None:
+                cache.close()
+            if not keep_intermediates:
+                rmtree(work_dir, ignore_errors=True)
+
+
+class _Options(object):
+    '''The options of a run shared by the annotation of all its batches.
+
+    See ``annotate`` for the parameters.
+    '''
+    def __init__(self, cache=None, result_cache=None, merged_db=False,
+                 hit_qualifiers=False, training_file=None, hit_table=False):
+        self.cache = cache
+        self.result_cache = result_cache
+        self.merged_db = merged_db
+        self.hit_qualifiers = hit_qualifiers
+        self.training_file = training_file
+        self.hit_table = hit_table
+
+
+def _run(batches, write, out_dir, processes, threads, pipeline, kingdom,
+         config, opts):
+    '''Annotate the batches and pass them to the writer in order.
+
+    See ``annotate`` for the parameters. ``opts`` is an ``_Options``.
+    '''
+    if processes > 1:
+        # DiamondCache is disabled for the parallel annotation
+        func = partial(_annotate_batch, out_dir=out_dir,
+                       kingdom=kingdom, config=config, cpus=threads,
+                       opts=opts)
+        with Pool(processes) as pool:
+            # imap keeps the order of the input sequences
+            for batch, _ in pool.imap(func, batches):
+                write(batch)
+    elif pipeline:
+        # the stages run at the same time, so they share the CPUs
+        first = threads // 2
+        stages = [
+            partial(_identify_batch, out_dir=out_dir, config=config,
+                    cpus=first, opts=opts),
+            # the cache is updated in place by this single stage
+            partial(_annotate_cds_batch, out_dir=out_dir,
+                    kingdom=kingdom, config=config,
+                    cpus=threads - first, opts=opts)]
+        # stop the stages right away if the writer fails
+        with closing(_pipeline(batches, stages)) as res:
+            for batch, _ in res:
+                write(batch)
+    else:
+        for batch in batches:
             # pass in and retrieve DiamondCache
-            im, cache = annotate_all_cds(im, seq_dir, kingdom, config, cache=cache)
+            batch, opts.cache = _annotate_batch(
+                batch, out_dir, kingdom, config, threads, opts)
+            write(batch)
+
+
+# the columns of the hit table of a run
+_HIT_TABLE_COLUMNS = ['seq_id', 'id', 'sseqid', 'evalue', 'bitscore',
+                      'partition']
+
+
+def _start_hits(fp, done):
+    '''Start the hit table of a run.
+
+    Parameters
+    ----------
+    fp : str
+        The hit table.
+    done : set of str
+        The IDs of the sequences already annotated. Their hits are kept
+        if the table exists and the rest is discarded.
+    '''
+    lines = []
+    if done and exists(fp):
+        with open(fp) as f:
+            next(f, None)
+            lines = [i for i in f if i.split('\t', 1)[0] in done]
+    with open(fp, 'w') as f:
+        f.write('\t'.join(_HIT_TABLE_COLUMNS) + '\n')
+        f.writelines(lines)
+
+
+def _append_hits(fp, batch_fp, seqs):
+    '''Append the hits of a batch to the hit table of the run.
+
+    Parameters
+    ----------
+    fp : str
+        The hit table.
+    batch_fp : str
+        The hits of the batch written by ``annotate_all_cds_batch``.
+    seqs : list of skbio.Sequence
+        The sequences of the batch.
+    '''
+    if not exists(batch_fp):
+        return
+    hits = pd.read_csv(batch_fp, sep='\t', dtype={'id': str})
+    # the feature IDs start with the ordinal of their sequence in the batch
+    ordinal = hits['id'].str.split('_').str[0].astype(int)
+    hits['seq_id'] = [seqs[i - 1].metadata['id'] for i in ordinal]
+    hits = hits.reindex(columns=_HIT_TABLE_COLUMNS)
+    hits.to_csv(fp, sep='\t', mode='a', header=False, index=False)
+
+
+def _hash_seq(seq):
+    '''Return the MD5 hex digest of the sequence and its ID.'''
+    h = md5(seq.metadata['id'].encode())
+    h.update(str(seq).encode())
+    return h.hexdigest()
+
+
+def _write_record(seq, out, out_fmt, manifest):
+    '''Write the annotated sequence and log it in the manifest.
+
+    Each line of the manifest has 3 tab-separated fields: the sequence
+    ID, the hash of the sequence, and the position in the output file
+    where the record ends.
+    '''
+    seq.write(out, format=out_fmt)
+    out.flush()
+    manifest.write('%s\t%s\t%d\n' % (
+        seq.metadata['id'], _hash_seq(seq), out.tell()))
+    manifest.flush()
+
+
+def _skip_done(seqs, manifest_fp):
+    '''Skip the sequences that are already annotated.
+
+    The sequences are compared against the manifest in order, and the
+    matching stops at the first one that differs.
+
+    Parameters
+    ----------
+    seqs : iterable of skbio.Sequence
+    manifest_fp : str
+        The manifest file written by ``_write_record``.
+
+    Returns
+    -------
+    tuple of iterator and list
+        The iterator over the sequences left to annotate and the
+        manifest entries of the annotated ones.
+    '''
+    with open(manifest_fp) as f:
+        entries = [line.rstrip('\n').split('\t') for line in f]
+    # ignore the possibly truncated last line
+    entries = [i for i in entries if len(i) == 3]
+    seqs = iter(seqs)
+    done = []
+    for entry, seq in zip(entries, seqs):
+        if entry[:2] != [seq.metadata['id'], _hash_seq(seq)]:
+            return chain([seq], seqs), done
+        done.append(entry)
+    return seqs, done
+
+
+def _schedule(cpus, processes=None):
+    '''Split the CPUs between parallel processes and tool threads.
+
+    Parameters
+    ----------
+    cpus : int
+        Total number of CPUs to use.
+    processes : int or None
+        Number of processes to run in parallel. If it is None, one
+        process is run for every ``_MAX_THREADS`` CPUs. It is capped at
+        ``cpus``.
+
+    Returns
+    -------
+    tuple of int
+        The number of processes and the number of threads for each of
+        the tools run in the processes. The thread option set for a tool
+        in the param config (e.g. ``--threads`` for diamond) overrides
+        the latter.
+    '''
+    if cpus < 1:
+        raise ValueError('The number of CPUs must be positive.')
+    if processes is None:
+        processes = max(1, cpus // _MAX_THREADS)
+    elif processes < 1:
+        raise ValueError('The number of processes must be positive.')
+    processes = min(processes, cpus)
+    # spread the remaining CPUs over the processes
+    threads = max(1, cpus // processes)
+    return processes, threads
+
+
+def _batch(seqs, size):
+    '''Group the sequences into lists of the given size.
+
+    Parameters
+    ----------
+    seqs : iterable of skbio.Sequence
+    size : int
+        The number of sequences in each batch. All of the sequences are
+        put in one batch if it is 0.
+
+    Yields
+    ------
+    list of skbio.Sequence
+    '''
+    seqs = iter(seqs)
+    if size == 0:
+        size = None
+    while True:
+        batch = list(islice(seqs, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _seq_fn(seq):
+    '''Return a file name derived from the sequence ID.'''
+    # replace non alnum char with "_"
+    return ''.join(x if x.isalnum() else '_' for x in seq.metadata['id'])
+
+
+def _name_batches(batches, start=0):
+    '''Name each batch after the position and ID of its first sequence.
+
+    The position makes the name unique even if the IDs of the first
+    sequences are the same after ``_seq_fn``, eg "ctg.1" and "ctg_1".
+
+    Parameters
+    ----------
+    batches : iterable of list of skbio.Sequence
+    start : int
+        The number of sequences before the first batch.
+
+    Yields
+    ------
+    tuple of str and list of skbio.Sequence
+    '''
+    pos = start
+    for seqs in batches:
+        yield '%d_%s' % (pos + 1, _seq_fn(seqs[0])), seqs
+        pos += len(seqs)
+
+
+def _annotate_batch(batch, out_dir, kingdom, config, cpus=1, opts=None):
+    '''Identify and annotate all the features of a batch of sequences.
+
+    Parameters
+    ----------
+    batch : tuple of str and list of skbio.Sequence
+        The name of the batch and its input sequence objects.
+    out_dir : str
+        Output directory. A sub-directory named after the batch is
+        created to store the intermediate files.
+    kingdom : str
+        Kingdom of the input sequence.
+    config : ``micronota.config.Configuration``
+        Container for configuration options.
+    cpus : int
+        Number of threads for each tool.
+    opts : ``_Options`` or None
+        The options of the run. The defaults of ``_Options`` are used if
+        it is None.
+
+    Returns
+    -------
+    tuple of the batch and ``DiamondCache``
+        The batch of annotated sequences and the updated cache.
+    '''
+    batch = _identify_batch(batch, out_dir, config, cpus, opts)
+    return _annotate_cds_batch(batch, out_dir, kingdom, config, cpus, opts)
+
+
+def _identify_batch(batch, out_dir, config, cpus=1, opts=None):
+    '''Identify all the features of a batch of sequences.
+
+    Returns
+    -------
+    tuple of str, list of skbio.Sequence and list of dict
+        The name of the batch, its sequences and the features identified
+        on each of them.
+    '''
+    if opts is None:
+        opts = _Options()
+    name, seqs = batch
+    # dir for useful intermediate files for the current input seqs
+    batch_dir = join(out_dir, name)
+    return name, seqs, identify_features_batch(
+        seqs, batch_dir, config, opts.result_cache, cpus,
+        opts.training_file)
+
+
+def _annotate_cds_batch(batch, out_dir, kingdom, config, cpus=1, opts=None):
+    '''Annotate the CDS of a batch and add all features to its sequences.
+
+    Parameters
+    ----------
+    batch : tuple of str, list of skbio.Sequence and list of dict
+        The output of ``_identify_batch``.
+
+    Returns
+    -------
+    tuple of the batch and ``DiamondCache``
+        The name and the annotated sequences of the batch, and the
+        updated cache.
+    '''
+    if opts is None:
+        opts = _Options()
+    name, seqs, ims = batch
+    batch_dir = join(out_dir, name)
+    # search the proteins of the whole batch together
+    ims, cache = annotate_all_cds_batch(
+        ims, batch_dir, kingdom, config, cpus=cpus, cache=opts.cache,
+        result_cache=opts.result_cache, merged_db=opts.merged_db,
+        hit_qualifiers=opts.hit_qualifiers, hit_table=opts.hit_table)
+    for seq, im in zip(seqs, ims):
+        seq.interval_metadata.concat(IntervalMetadata(im), inplace=True)
+    return (name, seqs), cache
+
+
+# the sentinel to signal the end of the stream in ``_pipeline``
+_DONE = object()
+
+
+def _pipeline(items, stages, maxsize=2):
+    '''Stream the items through the stages running concurrently.
+
+    Each stage runs in its own thread and hands its output over to the
+    next stage through a queue. The queues are bounded, so no more than
+    ``maxsize`` items wait between two stages and the memory use stays
+    bounded even for huge inputs.
+
+    Parameters
+    ----------
+    items : iterable
+        The input to the first stage. It is consumed lazily.
+    stages : list of callable
+        Each takes the output of the previous stage as its only argument.
+    maxsize : int
+        The maximal number of items waiting between two stages.
+
+    Yields
+    ------
+    The output of the last stage, in the same order as the input.
+
+    Raises
+    ------
+    Exception
+        The first exception raised in any of the stages is re-raised
+        after the stream is drained.
+
+    Notes
+    -----
+    If the generator is closed before the end of the stream, eg the
+    consumer fails on an item, the stages skip the rest of the items
+    and the queues are drained, so all the threads finish.
+    '''
+    queues = [Queue(maxsize) for _ in range(len(stages) + 1)]
+    errors = []
+    stop = Event()
+
+    def feed():
+        try:
+            for item in items:
+                if errors or stop.is_set():
+                    break
+                queues[0].put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queues[0].put(_DONE)
 
-            seq.interval_metadata.concat(IntervalMetadata(im), inplace=True)
-            seq.write(out, format=out_fmt)
+    def work(func, q_in, q_out):
+        while True:
+            item = q_in.get()
+            if item is _DONE:
+                break
+            # keep draining the queue but skip the work after a failure
+            if errors or stop.is_set():
+                continue
+            try:
+                q_out.put(func(item))
+            except Exception as e:
+                errors.append(e)
+        q_out.put(_DONE)
+
+    threads = [Thread(target=feed, daemon=True)]
+    for i, func in enumerate(stages):
+        threads.append(Thread(target=work, daemon=True,
+                              args=(func, queues[i], queues[i + 1])))
+    for t in threads:
+        t.start()
+
+    done = False
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                done = True
+                break
+            if not errors:
+                yield item
+    finally:
+        if not done:
+            # the consumer stopped early; let the threads run out
+            stop.set()
+            while queues[-1].get() is not _DONE:
+                pass
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
 
 
 def identify_all_features(seq, out_dir, config):
@@ -93,34 +640,178 @@ def identify_all_features(seq, out_dir, config):
     dict :
         Dictionary of skbio.metadata.Feature objects.
     '''
+    return identify_features_batch([seq], out_dir, config)[0]
+
+
+def identify_features_batch(seqs, out_dir, config, result_cache=None,
+                            cpus=1, training_file=None):
+    '''Identify all the features for a batch of sequences.
+
+    All the sequences are written into one fasta file, so each tool
+    is run only once for the whole batch. The features are then
+    split back per sequence.
+
+    Parameters
+    ----------
+    seqs : list of skbio.Sequence
+        Input sequence objects.
+    out_dir : str
+        Output directory.
+    config : ``micronota.config.Configuration``
+        Container for configuration options.
+    result_cache : ``micronota.cache.ResultCache`` or None
+        If it is given, the features of the sequences found in the
+        cache are reused and only the rest are passed to the tools.
+    cpus : int
+        Number of CPUs for each tool.
+    training_file : str or None
+        The Prodigal training file (see ``annotate``).
+
+    Returns
+    -------
+    list of dict :
+        Dictionary of skbio.metadata.Feature objects for each of
+        the input sequences, in the same order.
+    '''
     logger = getLogger(__name__)
     logger.info('Running feature identification.')
-    im = dict()
-    with NamedTemporaryFile('w+') as f:
-        seq.write(f.name, format='fasta')
-        for tool in config.features:
-            db = config.features[tool]
-            if db is not None:
-                db = config.db[db]
-            seq_dir = join(out_dir, tool)
-            submodule = import_module('.%s' % tool, bfillings.__name__)
-            cls = getattr(submodule, 'FeaturePred')
-            obj = cls(db, seq_dir)
-            if tool in config.param:
-                params = config.param[tool]
+    ims = [dict() for _ in seqs]
+    if result_cache is not None:
+        digests = [_digest(str(seq)) for seq in seqs]
+    for tool in config.features:
+        db = config.features[tool]
+        if db is not None:
+            db = config.db[db]
+        seq_dir = join(out_dir, tool)
+        submodule = import_module('.%s' % tool, bfillings.__name__)
+        cls = getattr(submodule, 'FeaturePred')
+        obj = cls(db, seq_dir)
+        if tool in config.param:
+            params = config.param[tool]
+        else:
+            params = None
+
+        todo = list(range(len(seqs)))
+        if result_cache is not None:
+            tool_key = _tool_key(tool, [db], params)
+            if tool == 'prodigal' and training_file is not None:
+                tool_key += (file_version([training_file]),)
+            whole = _whole_input(tool, params)
+            if whole:
+                # the features of a seq depend on the rest of the batch
+                tool_key += (_digest(''.join(digests)),)
+            keys = [result_cache.key(i, tool_key) for i in digests]
+            cached = result_cache.get_many(keys)
+            todo = [i for i, k in enumerate(keys) if k not in cached]
+            if whole and todo:
+                # don't mix with the predictions from another input
+                cached = {}
+                todo = list(range(len(seqs)))
+            logger.info('Found %d of %d sequence(s) in the cache for %s.' % (
+                len(seqs) - len(todo), len(seqs), tool))
+            for i, k in enumerate(keys):
+                if k in cached:
+                    ims[i].update(_renumber(cached[k], i + 1))
+        if not todo:
+            continue
+
+        new = {}
+        with NamedTemporaryFile('w+') as f:
+            for i in todo:
+                seqs[i].write(f, format='fasta')
+            f.flush()
+            # the tool yields one dict for each input seq in order. the
+            # trailing seqs without any feature may be missing.
+            if tool == 'prodigal':
+                kwargs = {'training_file': training_file}
             else:
-                params = None
-            im.update(next(obj(f.name, params=params)))
-    return im
+                kwargs = {}
+            res = obj(f.name, cpus=cpus, params=params, **kwargs)
+            for i, im in zip(todo, chain(res, repeat({}))):
+                # the seq is numbered by its position in the batch
+                im = _renumber(im, i + 1)
+                ims[i].update(im)
+                if result_cache is not None:
+                    new[keys[i]] = im
+        if new:
+            result_cache.put_many(new)
+    return ims
+
+
+def _digest(s):
+    '''Return the MD5 hex digest of the string.'''
+    return md5(s.encode()).hexdigest()
+
 
+def _tool_key(tool, dbs, params):
+    '''Return what identifies the results of the tool for the cache.
 
-def annotate_all_cds(im, out_dir, kingdom, config, cpus=1, cache=None):
+    Parameters
+    ----------
+    tool : str
+        The tool name.
+    dbs : list of str
+        The database files used by the tool.
+    params : dict or None
+        The parameters of the tool.
+    '''
+    if params is None:
+        params = {}
+    return (tool, tool_version(tool), file_version(dbs),
+            sorted(dict(params).items()))
+
+
+def _whole_input(tool, params):
+    '''Return whether the tool learns from all the input sequences.
+
+    Prodigal trains its model on the whole input except in the
+    metagenomic mode, so its genes on a sequence depend on the other
+    sequences of the same input file.
+    '''
+    if params is None:
+        params = {}
+    return tool == 'prodigal' and dict(params).get('-p', 'single') != 'meta'
+
+
+def _renumber(im, ordinal):
+    '''Set the ordinal number of the parent sequence in the feature IDs.
+
+    The features predicted by Prodigal have the IDs like "1_2", which is
+    the 2nd gene on the 1st sequence of the input file.
+
+    Parameters
+    ----------
+    im : dict passable to IntervalMetadata
+    ordinal : int
+        The 1-based position of the sequence in the batch.
+
+    Returns
+    -------
+    dict passable to IntervalMetadata
+    '''
+    prefix = '%d_' % ordinal
+    new = {}
+    for feature, intervals in im.items():
+        try:
+            id = feature['id']
+        except KeyError:
+            id = None
+        if id is not None and _ID_PATTERN.match(id) and \
+           not id.startswith(prefix):
+            feature = feature.update(id=prefix + id.split('_', 1)[1])
+        new[feature] = intervals
+    return new
+
+
+def annotate_all_cds(im, out_dir, kingdom, config, cpus=1, cache=None,
+                     result_cache=None, merged_db=False,
+                     hit_qualifiers=False):
     '''Annotate coding domain sequences (CDS).
 
     Parameters
     ----------
-    seq : skbio.Sequence
-        Input sequence object.
+    im : dict
+        Dictionary of skbio.metadata.Feature objects of a sequence.
     out_dir : str
         Output directory.
     config : ``micronota.config.Configuration``
@@ -136,65 +827,285 @@ def annotate_all_cds(im, out_dir, kingdom, config, cpus=1, cache=None):
     im : skbio.metadata.IntervalMetadata
         Interval metadata object
     '''
+    ims, cache = annotate_all_cds_batch(
+        [im], out_dir, kingdom, config, cpus=cpus, cache=cache,
+        result_cache=result_cache, merged_db=merged_db,
+        hit_qualifiers=hit_qualifiers)
+    return ims[0], cache
+
+
+def annotate_all_cds_batch(ims, out_dir, kingdom, config, cpus=1,
+                           cache=None, result_cache=None, merged_db=False,
+                           hit_qualifiers=False, hit_table=False):
+    '''Annotate coding domain sequences (CDS) of a batch of sequences.
+
+    The proteins from all the sequences are pooled into one query file,
+    so each tool (and each database of the cascade) is run only once for
+    the whole batch. The hits are then joined back onto each sequence.
+
+    Parameters
+    ----------
+    ims : list of dict
+        Dictionary of skbio.metadata.Feature objects for each sequence.
+        The feature IDs must be unique across the batch, which is the
+        case for the features from ``identify_features_batch``.
+    out_dir : str
+        Output directory.
+    config : ``micronota.config.Configuration``
+        Container for configuration options.
+    kingdom : str
+        Kingdom (i.e. virus, bacteria ...) of the input sequence. It will
+        be used to prioritize databases to search.
+    cpus : int
+        Number of CPUs to use.
+    result_cache : ``micronota.cache.ResultCache`` or None
+        If it is given, the hits of the proteins found in the cache are
+        reused and only the rest of the proteins are searched.
+    merged_db : boolean
+        Whether to search UniRef in one pass against the merged database
+        instead of the cascade of its partitions. The best hits of each
+        protein are kept and the one in the partition of the highest
+        priority for the kingdom is picked, as the cascade would do.
+    hit_qualifiers : boolean
+        Whether to add the e-value, bitscore and database partition of
+        the hits as the qualifiers of the CDS besides the hit ID
+        ("db_xref").
+    hit_table : boolean
+        Whether to write the hits to "hits.tsv" in ``out_dir`` for the
+        hit table of the run.
+
+    Notes
+    -----
+    If the UniRef database has the exact match index (see
+    ``micronota.db._exact``), the proteins identical to a UniRef
+    sequence in the partition of the top priority for the kingdom are
+    resolved with it before the homology search. Their hits have the
+    e-value of 0 and no bitscore.
+
+    Returns
+    -------
+    tuple of list of dict and ``DiamondCache``
+        The updated feature dicts in the same order as the input and
+        the cache.
+    '''
     logger = getLogger(__name__)
     logger.info('Running CDS functional annotation.')
     id_key = 'id'
-    res = pd.DataFrame()
+    features = [feature for im in ims for feature in im]
+    # collect the hit tables and concatenate them once at the end
+    hits = []
+    found = set()
     for tool in config.cds:
         d = join(out_dir, tool)
         makedirs(d, exist_ok=True)
         pro_fp = join(d, '%s.fa' % tool)
 
-        # write the protein seq into a file
-        _write_cds(
-            pro_fp, im, id_key,
-            lambda x: x['type_'] == 'CDS' and x[id_key] not in res.index)
-        if stat(pro_fp).st_size == 0:
-            break
         db = config.cds[tool]
-        if db in ['uniref100', 'uniref90', 'uniref50']:
+        partition_fp = None
+        exact_prefix = None
+        priority = []
+        if db in ['uniref100', 'uniref90', 'uniref50'] and merged_db:
+            db_dir = config.db[db]
+            db_fp = [join(db_dir, 'merged')]
+            partition_fp = join(db_dir, 'partition.db')
+            if not (exists('%s.dmnd' % db_fp[0]) and exists(partition_fp)):
+                raise ValueError(
+                    'Merged database of %s is not available. Prepare it '
+                    'with "micronota database prepare --merge".' % db)
+            exact_prefix = join(db_dir, 'exact')
+            priority = _get_uniref_db(kingdom)
+        elif db in ['uniref100', 'uniref90', 'uniref50']:
             db_dir = config.db[db]
             db_fp = [join(db_dir, i) for i in _get_uniref_db(kingdom)]
             # in case the db file is empty
             db_fp = [i for i in db_fp if exists('%s.dmnd' % i)]
+            exact_prefix = join(db_dir, 'exact')
+            priority = [basename(i) for i in db_fp]
         elif db == 'tigrfam':
             pass
         else:
             raise ValueError('Database %s is not available.' % db)
+        if tool in config.param:
+            params = config.param[tool]
+        else:
+            params = None
+
+        cds = [i for i in features
+               if i['type_'] == 'CDS' and i[id_key] not in found]
+        cached = {}
+        if result_cache is not None:
+            tool_key = _tool_key(
+                tool, ['%s.dmnd' % i for i in db_fp], params)
+            if partition_fp is not None:
+                # the hit picked depends on the priority of the partitions
+                tool_key += (_get_uniref_db(kingdom),)
+            keys = {i[id_key]: result_cache.key(
+                _digest(i['translation']), tool_key) for i in cds}
+            values = result_cache.get_many(set(keys.values()))
+            # the value is None if the protein has no hit
+            cached = {i: values[k] for i, k in keys.items() if k in values}
+            cds = [i for i in cds if i[id_key] not in cached]
+            logger.info('Found %d protein(s) in the cache for %s.' % (
+                len(cached), tool))
+            res_ = pd.DataFrame.from_dict(
+                {i: cached[i] for i in cached if cached[i] is not None},
+                orient='index')
+            hits.append(res_)
+            found.update(res_.index)
+
+        matched = {}
+        if (exact_prefix is not None and priority and
+                index_exists(exact_prefix)):
+            # the proteins identical to a reference need no search. only
+            # the matches in the partition of the top priority are taken,
+            # as the search would pick them too; the rest may hit a
+            # partition of higher priority and are left to the search.
+            matched = ExactIndex(exact_prefix).lookup(
+                {i[id_key]: i['translation'] for i in cds},
+                partition=_partitions.index(priority[0]))
+            cds = [i for i in cds if i[id_key] not in matched]
+            logger.info('Found %d protein(s) in the exact match index.' % (
+                len(matched)))
+            res_ = pd.DataFrame.from_dict(
+                {i: {'sseqid': sseqid, 'evalue': 0.0,
+                     'bitscore': float('nan'),
+                     'partition': _partitions[code]}
+                 for i, (sseqid, code) in matched.items()},
+                orient='index')
+            hits.append(res_)
+            found.update(res_.index)
+
+        # write the protein seq into a file, one copy for identical ones
+        groups = _write_cds(pro_fp, cds, id_key)
+        if stat(pro_fp).st_size == 0:
+            if cached or matched:
+                continue
+            break
 
         submodule = import_module('.%s' % tool, bfillings.__name__)
         cls = getattr(submodule, 'FeatureAnnt')
-        if tool == 'diamond':
+        # the hits against DiamondCache can't be resolved to a partition
+        if tool == 'diamond' and partition_fp is None:
             obj = cls(dat=db_fp, out_dir=d, cache=cache)
         else:
             obj = cls(dat=db_fp, out_dir=d)
-        if tool in config.param:
-            params = config.param[tool]
+        if partition_fp is None:
+            res_ = obj(pro_fp, cpus=cpus, params=params)
         else:
-            params = None
-        res_ = obj(pro_fp, cpus=cpus, params=params)
-        res = res.append(res_)
-    return _update(im, id_key, res), obj.cache
+            top = int(params.get('--max-target-seqs', 25)) if params else 25
+            res_ = obj(pro_fp, cpus=cpus, params=params, top=top)
+            res_ = _resolve_partition(
+                res_, partition_fp, _get_uniref_db(kingdom))
+        res_ = _fan_out(res_, groups)
+        hits.append(res_)
+        found.update(res_.index)
+        if result_cache is not None:
+            rows = res_.to_dict('index')
+            result_cache.put_many(
+                {keys[i[id_key]]: rows.get(i[id_key]) for i in cds})
+    # the cache is updated in place
+    if hits:
+        res = pd.concat(hits)
+    else:
+        res = pd.DataFrame()
+    if hit_table:
+        # keep the hits for the hit table of the run
+        hits_fp = join(out_dir, 'hits.tsv')
+        if not res.empty:
+            makedirs(out_dir, exist_ok=True)
+            res[~res.index.duplicated()].to_csv(
+                hits_fp, sep='\t', index_label='id')
+        elif exists(hits_fp):
+            remove(hits_fp)
+    hit_map = _hit_map(res)
+    return [_update(im, id_key, hit_map, hit_qualifiers) for im in ims], cache
+
 
+def _resolve_partition(hits, partition_fp, priority):
+    '''Pick the best hit of each query in the partition of top priority.
 
-def _update(im, id_key, res):
+    Parameters
+    ----------
+    hits : pandas.DataFrame
+        The hits against the merged database, indexed by the query IDs,
+        with the columns of "sseqid" and "bitscore".
+    partition_fp : str
+        The partition table of the merged database.
+    priority : list of str
+        The partitions in the order of priority.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One hit for each query with the additional column "partition".
+    '''
+    if hits.empty:
+        return hits
+    partitions = lookup_partition(partition_fp, hits['sseqid'].unique())
+    rank = {p: i for i, p in enumerate(priority)}
+    hits = hits.assign(partition=hits['sseqid'].map(partitions))
+    hits = hits.assign(rank=hits['partition'].map(rank))
+    # the hits in partitions of no priority are discarded
+    hits = hits[hits['rank'].notnull()]
+    hits = hits.sort_values(['rank', 'bitscore'], ascending=[True, False],
+                            kind='mergesort')
+    hits = hits[~hits.index.duplicated()].sort_index(kind='mergesort')
+    return hits.drop('rank', axis=1)
+
+
+# the columns of the hit table added to the features by ``_update``
+_HIT_QUALIFIERS = ['evalue', 'bitscore', 'partition']
+
+
+def _hit_map(res):
+    '''Map the feature IDs to their hits.
+
+    Parameters
+    ----------
+    res : pandas.DataFrame
+        The hit table indexed by the feature IDs. If an ID occurs more
+        than once, its first hit is used.
+
+    Returns
+    -------
+    dict
+        The hit of each feature ID as a dict of the columns.
+    '''
+    if res.empty:
+        return {}
+    return res[~res.index.duplicated()].to_dict('index')
+
+
+def _update(im, id_key, hits, qualifiers=False):
     '''
     Parameters
     ----------
     im : dict passable to IntervalMetadata
+    id_key : str
+        key in ``Feature`` to get its value as the ID to look up.
+    hits : dict
+        The hits from ``_hit_map``.
+    qualifiers : boolean
+        Whether to add the e-value, bitscore and partition of the hit.
     '''
-    features = list(im)
-    for feature in features:
-        id = feature[id_key]
-        if id in res.index:
-            new_feature = feature.update(db_xref=res.loc[id, 'sseqid'])
-            im[new_feature] = im.pop(feature)
+    for feature in list(im):
+        hit = hits.get(feature[id_key])
+        if hit is None:
+            continue
+        kwargs = {'db_xref': hit['sseqid']}
+        if qualifiers:
+            kwargs.update((k, hit[k]) for k in _HIT_QUALIFIERS
+                          if k in hit and pd.notnull(hit[k]))
+        im[feature.update(**kwargs)] = im.pop(feature)
     return im
 
 
 def _write_cds(fp, im, id_key, select=lambda x: x['type_'] == 'CDS'):
     '''Return a fasta file of all the proteins of a sequence.
 
+    Identical proteins are written only once, under the ID of the first
+    of them.
+
     Parameters
     ----------
     fp : str
@@ -204,13 +1115,51 @@ def _write_cds(fp, im, id_key, select=lambda x: x['type_'] == 'CDS'):
         key in ``Feature`` to get its value as seq ID
     select : callable
         what CDS to write down.
+
+    Returns
+    -------
+    dict
+        The IDs of the identical proteins keyed by the ID written.
     '''
-    with open(fp, 'w') as f:
-        for feature in im:
-            if select(feature):
-                pro = Sequence(
-                    feature['translation'], {'id': feature[id_key]})
-                pro.write(f, format='fasta')
+    groups = {}
+    reps = {}
+    records = []
+    for feature in im:
+        if select(feature):
+            id = feature[id_key]
+            translation = feature['translation']
+            if translation in reps:
+                groups[reps[translation]].append(id)
+            else:
+                reps[translation] = id
+                groups[id] = [id]
+                records.append((id, translation))
+    _write_fasta(fp, records)
+    return groups
+
+
+def _fan_out(res, groups):
+    '''Copy the hits of the proteins written to their identical ones.
+
+    Parameters
+    ----------
+    res : pandas.DataFrame
+        The hits indexed by the IDs written by ``_write_cds``.
+    groups : dict
+        The return of ``_write_cds``.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The hits indexed by the IDs of all the proteins.
+    '''
+    pos = [i for i, id in enumerate(res.index) for _ in groups.get(id, [id])]
+    if len(pos) == len(res):
+        return res
+    ids = [j for id in res.index for j in groups.get(id, [id])]
+    res = res.iloc[pos]
+    res.index = pd.Index(ids, name=res.index.name)
+    return res
 
 
 def _get_uniref_db(kingdom):